@@ -0,0 +1,1093 @@
+"""
+Нагрузочные замеры бота без сети: локальные фейковые Supabase (PostgREST) и Bot API
+и прогон обработчиков bot.py против них.
+
+    python bench.py db --users 200 --latency 0.02
+    python bench.py loadtest --users 100 --rate 300
+    python bench.py suite --users 100 --rate 500 [--only survey,feedback] [--verbose]
+    python bench.py scale --users 200 --workers 1,2,4
+    python bench.py check [--only outbox_partial_batch]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import asyncio
+import argparse
+import logging
+import tempfile
+import threading
+import multiprocessing
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+from email.parser import BytesParser
+from email.policy import HTTP
+
+
+class _Server(ThreadingHTTPServer):
+    # Стандартная очередь accept() на 5 соединений теряет SYN при всплеске параллельных
+    # запросов, и клиент ждёт повторной отправки ~1 сек — это мерило бы фейк, а не бота.
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл соединение (например, long polling при остановке бота) — это не ошибка фейка
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+# ---------- Фейковый Supabase ----------
+# Первичные ключи таблиц: по ним работает upsert без on_conflict.
+PRIMARY_KEYS = {
+    "users": ("user_id",),
+    "survey_progress": ("user_id", "survey_number"),
+    "survey_results": ("id",),
+    "feedback": ("id",),
+    "moderator_replies": ("id",),
+}
+SERIAL_TABLES = ("survey_results", "feedback", "moderator_replies")
+
+
+def _coerce(value: str):
+    if value == "null":
+        return None
+    if value in ("true", "false"):
+        return value == "true"
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def _split_top(expr: str):
+    """Делит 'a.eq.1,and(b.eq.2,c.gt.3)' по запятым верхнего уровня."""
+    parts, depth, start = [], 0, 0
+    for i, ch in enumerate(expr):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            parts.append(expr[start:i])
+            start = i + 1
+    parts.append(expr[start:])
+    return parts
+
+
+def _match_logic(row: dict, op: str, expr: str) -> bool:
+    results = []
+    for term in _split_top(expr.strip()[1:-1]):
+        if term.startswith(("and(", "or(")):
+            inner_op, _, rest = term.partition("(")
+            results.append(_match_logic(row, inner_op, "(" + rest))
+        else:
+            column, _, cond = term.partition(".")
+            results.append(_match(row, column, cond))
+    return all(results) if op == "and" else any(results)
+
+
+def _match(row: dict, column: str, expr: str) -> bool:
+    if column in ("or", "and"):
+        return _match_logic(row, column, expr)
+    op, _, raw = expr.partition(".")
+    if op == "not":
+        inner_op, _, raw = raw.partition(".")
+        return not _match(row, column, f"{inner_op}.{raw}")
+    value = row.get(column)
+    if op == "in":
+        return value in [_coerce(v.strip('"')) for v in raw.strip("()").split(",") if v]
+    if op == "is":
+        return value is _coerce(raw)
+    criteria = _coerce(raw)
+    if op == "eq":
+        return value == criteria
+    if op == "neq":
+        return value != criteria
+    if value is None:
+        return False
+    if op == "gt":
+        return value > criteria
+    if op == "gte":
+        return value >= criteria
+    if op == "lt":
+        return value < criteria
+    if op == "lte":
+        return value <= criteria
+    raise ValueError(f"unsupported operator {op}")
+
+
+class FakeSupabase:
+    """Таблицы в памяти + HTTP-сервер с подмножеством PostgREST, которое использует бот."""
+
+    def __init__(self, latency: float = 0.0, max_rows: int = None):
+        self.latency = latency
+        # Как «Max rows» в Supabase: GET отдаёт не больше строк, чем здесь, какой бы ни был limit
+        self.max_rows = max_rows
+        self.tables = {name: [] for name in PRIMARY_KEYS}
+        self.serial = {name: 0 for name in SERIAL_TABLES}
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    # --- запуск ---
+    def start(self) -> str:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                status, payload = fake.handle(self.command, self.path, dict(self.headers), body)
+                data = b"" if payload is None else json.dumps(payload, default=str).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+        self._server = _Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def round_trips(self) -> int:
+        return sum(self.requests.values())
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+
+    # --- разбор запроса ---
+    def handle(self, method: str, path: str, headers: dict, body):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(path)
+        table = url.path.rsplit("/", 1)[-1]
+        params = parse_qsl(url.query, keep_blank_values=True)
+        prefer = {h.strip() for h in headers.get("Prefer", headers.get("prefer", "")).split(",") if h.strip()}
+        with self._lock:
+            key = f"{method} {table}"
+            self.requests[key] = self.requests.get(key, 0) + 1
+            try:
+                if "/rpc/" in url.path:
+                    return 200, self._rpc(table, body or {})
+                rows = self._dispatch(method, table, params, prefer, body)
+            except (KeyError, ValueError) as e:
+                return 400, {"message": str(e), "code": "PGRST000", "hint": None, "details": None}
+        if "return=minimal" in prefer:
+            return 204, None
+        return (201 if method == "POST" else 200), rows
+
+    def _dispatch(self, method, table, params, prefer, body):
+        rows = self.tables[table]
+        filters = [(k, v) for k, v in params if k not in ("select", "order", "limit", "offset", "on_conflict", "columns")]
+        opts = {k: v for k, v in params if k in ("select", "order", "limit", "offset", "on_conflict")}
+
+        if method == "GET":
+            found = [r for r in rows if all(_match(r, c, e) for c, e in filters)]
+            for part in reversed((opts.get("order") or "").split(",")):
+                if part:
+                    column, _, direction = part.partition(".")
+                    found.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=direction.startswith("desc"))
+            offset = int(opts.get("offset", 0))
+            found = found[offset:]
+            if "limit" in opts:
+                found = found[:int(opts["limit"])]
+            if self.max_rows:
+                found = found[:self.max_rows]
+            return self._project(found, opts.get("select", "*"))
+
+        if method == "POST":
+            items = body if isinstance(body, list) else [body]
+            conflict = tuple(opts["on_conflict"].split(",")) if opts.get("on_conflict") else PRIMARY_KEYS[table]
+            upsert = any(p.startswith("resolution=") for p in prefer)
+            ignore = "resolution=ignore-duplicates" in prefer
+            out = []
+            for item in items:
+                existing = None
+                if upsert and all(c in item for c in conflict):
+                    existing = next((r for r in rows if all(r.get(c) == item[c] for c in conflict)), None)
+                if existing is not None:
+                    if not ignore:
+                        existing.update(item)
+                        out.append(existing)
+                    continue
+                row = dict(item)
+                if table in SERIAL_TABLES and row.get("id") is None:
+                    self.serial[table] += 1
+                    row["id"] = self.serial[table]
+                row.setdefault("created_at", datetime.now().isoformat())
+                rows.append(row)
+                out.append(row)
+            return self._project(out, opts.get("select", "*"))
+
+        if method == "PATCH":
+            found = [r for r in rows if all(_match(r, c, e) for c, e in filters)]
+            for r in found:
+                r.update(body)
+            return self._project(found, opts.get("select", "*"))
+
+        if method == "DELETE":
+            found = [r for r in rows if all(_match(r, c, e) for c, e in filters)]
+            self.tables[table] = [r for r in rows if r not in found]
+            return self._project(found, opts.get("select", "*"))
+
+        raise ValueError(f"unsupported method {method}")
+
+    def _rpc(self, name, params):
+        # Повторяет функции из БД/migrations.sql
+        if name == "commit_survey":
+            uid, survey = params["p_user_id"], params["p_survey_number"]
+            results = self.tables["survey_results"]
+            old = [r for r in results if r["user_id"] == uid and r["survey_number"] == survey]
+            self.tables["survey_results"] = [r for r in results if r not in old]
+            self._dispatch("POST", "survey_results", [], set(), [
+                {"user_id": uid, "survey_number": survey, **a} for a in params["p_answers"]
+            ])
+            self._dispatch("POST", "survey_progress", [], {"resolution=merge-duplicates"},
+                           {"user_id": uid, "survey_number": survey, "status": "completed"})
+            return [{"question_number": r["question_number"], "answer": r["answer"]} for r in old]
+        raise KeyError(f"unknown function {name}")
+
+    @staticmethod
+    def _project(rows, select):
+        if select in ("*", ""):
+            return [dict(r) for r in rows]
+        columns = [c.strip() for c in select.split(",")]
+        return [{c: r.get(c) for c in columns} for r in rows]
+
+
+# ---------- Фейковый Telegram Bot API ----------
+class FakeTelegram:
+    """HTTP-сервер, отвечающий на методы Bot API правдоподобными объектами."""
+
+    BOT_USER = {"id": 999, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        # Отправленные sendMessage (chat_id, text) и номера вызовов, которые ответят ошибкой
+        self.sent = []
+        self.fail_calls = {}
+        self.updates = []
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._new_updates = threading.Condition(self._lock)
+        self._server = None
+
+    def start(self) -> str:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length)
+                params = fake._parse(self.headers.get("Content-Type", ""), raw)
+                method = self.path.rsplit("/", 1)[-1]
+                result = fake.handle(method, params)
+                data = json.dumps(result).encode()
+                self.send_response(result.get("error_code", 200))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+        self._server = _Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}/bot"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+
+    @staticmethod
+    def _parse(content_type: str, raw: bytes) -> dict:
+        if not raw:
+            return {}
+        if content_type.startswith("multipart/"):
+            msg = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + raw)
+            return {part.get_param("name", header="content-disposition"): part.get_content()
+                    for part in msg.iter_parts()}
+        if content_type.startswith("application/json"):
+            return json.loads(raw)
+        return dict(parse_qsl(raw.decode()))
+
+    def push_updates(self, updates):
+        """Кладёт апдейты в очередь, которую бот заберёт через getUpdates (polling)."""
+        with self._lock:
+            self.updates.extend(updates)
+            self._new_updates.notify_all()
+
+    def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        with self._lock:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            if not self.updates:
+                # Long polling, но не дольше секунды: бенчмарку не нужно ждать таймаут клиента
+                self._new_updates.wait(min(float(params.get("timeout") or 0), 1.0))
+            return {"ok": True, "result": self.updates[:limit]}
+
+    def handle(self, method: str, params: dict):
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.calls[method] in self.fail_calls.get(method, ()):
+                return {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+            self._message_id += 1
+            message_id = self._message_id
+            if method == "sendMessage":
+                self.sent.append((int(params.get("chat_id") or 0), params.get("text", "")))
+        if method == "getMe":
+            return {"ok": True, "result": self.BOT_USER}
+        if method in ("sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageReplyMarkup"):
+            chat_id = int(params.get("chat_id") or 0)
+            message = {"message_id": message_id, "date": int(time.time()),
+                       "chat": {"id": chat_id, "type": "private"}, "from": self.BOT_USER}
+            if method == "sendPhoto":
+                photo = params.get("photo")
+                key = photo if isinstance(photo, str) else str(message_id)
+                message["photo"] = [{"file_id": f"fid-{abs(hash(key))}", "file_unique_id": f"u{message_id}",
+                                     "width": 1, "height": 1}]
+                message["caption"] = params.get("caption")
+            elif method == "sendDocument":
+                message["document"] = {"file_id": f"doc-{message_id}", "file_unique_id": f"d{message_id}"}
+            else:
+                message["text"] = params.get("text", "")
+            return {"ok": True, "result": message}
+        return {"ok": True, "result": True}
+
+
+# ---------- Импорт бота с фейковым окружением ----------
+def load_bot(supabase_url: str, telegram_url: str = None, **env):
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench",
+        "SUPABASE_URL": supabase_url,
+        "SUPABASE_KEY": "bench.bench.bench",
+        "MODERATOR_CHAT_ID": "1",
+        "STATE_DB_PATH": os.path.join(workdir, "state.sqlite3"),
+        "FILE_ID_CACHE_PATH": os.path.join(workdir, "file_ids.json"),
+        "PREWARM_IMAGES": "0",
+        "METRICS_PORT": "0",
+    })
+    if telegram_url:
+        os.environ["TELEGRAM_BASE_URL"] = telegram_url
+    os.environ.update({key: str(value) for key, value in env.items()})
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("telegram.ext").setLevel(logging.WARNING)
+    return bot
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# ---------- Сценарий: параллельные обращения к БД ----------
+async def _db_round(bot, users: int):
+    """Имитирует апдейты /start + проверку прогресса от `users` разных пользователей одновременно."""
+    latencies = []
+
+    async def one(uid):
+        t0 = time.perf_counter()
+        await bot.add_user(uid, f"user{uid}", f"User {uid}")
+        await bot.get_survey_progress(uid, 1)
+        latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(1000 + i) for i in range(users)))
+    return time.perf_counter() - t0, latencies
+
+
+def bench_db(args):
+    fake = FakeSupabase(latency=args.latency)
+    bot = load_bot(fake.start())
+    pooled_execute = bot._execute
+
+    async def blocking_execute(query):
+        # Поведение до пула: синхронный запрос прямо в event loop.
+        return query.execute()
+
+    print(f"{'mode':<10}{'updates':>9}{'seconds':>10}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'round trips':>13}")
+    for mode, execute in (("blocking", blocking_execute), ("pooled", pooled_execute)):
+        fake.tables = {name: [] for name in PRIMARY_KEYS}
+        fake.reset_counters()
+        bot._known_users.clear()
+        bot.progress_cache._data.clear()
+        bot._execute = execute
+        elapsed, latencies = asyncio.run(_db_round(bot, args.users))
+        print(f"{mode:<10}{args.users:>9}{elapsed:>10.2f}{args.users / elapsed:>10.1f}"
+              f"{_percentile(latencies, 50) * 1000:>10.1f}{_percentile(latencies, 99) * 1000:>10.1f}"
+              f"{fake.round_trips:>13}")
+    bot._execute = pooled_execute
+    fake.stop()
+
+
+# ---------- Синтетический поток апдейтов ----------
+MODERATOR_ID = 1
+
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"user{uid}"}
+
+
+def make_message(update_id: int, uid: int, text: str) -> dict:
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+               "from": _user(uid), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def make_callback(update_id: int, uid: int, data: str) -> dict:
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": _user(uid), "chat_instance": str(uid), "data": data,
+        "message": {"message_id": update_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                    "from": FakeTelegram.BOT_USER, "text": "..."},
+    }}
+
+
+def survey_steps(survey: int = 1):
+    """Полное прохождение опроса из меню: выбор опроса, два ответа кнопками и свободный ответ."""
+    return [
+        ("callback", f"survey_{survey}"),
+        ("callback", f"answer_{survey}_1_0"),
+        ("callback", f"answer_{survey}_2_1"),
+        ("message", "Свободный ответ на третий вопрос"),
+    ]
+
+
+def survey_script(survey: int = 1):
+    """Шаги одного пользователя: /start, меню, полное прохождение опроса."""
+    return [("message", "/start"), ("message", "📜 Меню"), *survey_steps(survey)]
+
+
+def interleave(scripts: dict):
+    """Склеивает сценарии пользователей по кругу: шаг k любого пользователя идёт после его шага k-1."""
+    stream, update_id = [], 0
+    longest = max(len(steps) for steps in scripts.values())
+    for k in range(longest):
+        for uid, steps in scripts.items():
+            if k < len(steps):
+                kind, payload = steps[k]
+                update_id += 1
+                make = make_message if kind == "message" else make_callback
+                stream.append(make(update_id, uid, payload))
+    return stream
+
+
+# Как апдейты попадают в бота: queue — прямо в update_queue (без сетевой части), polling — через
+# getUpdates фейкового Telegram, webhook — POST-запросами на слушатель бота, как их шлёт Telegram.
+TRANSPORTS = ("queue", "polling", "webhook")
+WEBHOOK_SECRET = "bench-secret"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Driver:
+    """Запущенное Application бота, в которое подаются потоки апдейтов (async with Driver(...) as d)."""
+
+    def __init__(self, bot, concurrency: int, transport: str = "queue", fake_tg=None):
+        self.bot = bot
+        self.app = bot.build_application(concurrency)
+        self.transport = transport
+        self.fake_tg = fake_tg
+        self._webhook_url = None
+        self._http = None
+        self._started = {}
+        self._latencies = []
+        self._expected = 0
+        self._done = asyncio.Event()
+
+    async def __aenter__(self):
+        import httpx
+        from telegram import Update
+        from telegram.ext import TypeHandler
+
+        # Последняя группа: срабатывает после основного обработчика апдейта.
+        self.app.add_handler(TypeHandler(Update, self._finished), group=99)
+        await self.app.initialize()
+        await self.app.post_init(self.app)
+        if self.transport == "polling":
+            with self.fake_tg._lock:
+                self.fake_tg.updates.clear()
+            await self.app.updater.start_polling(poll_interval=0)
+        elif self.transport == "webhook":
+            # То же, что делает run_webhook, только без собственного event loop
+            port = _free_port()
+            self._webhook_url = f"http://127.0.0.1:{port}/telegram"
+            await self.app.updater.start_webhook(listen="127.0.0.1", port=port, url_path="telegram",
+                                                 webhook_url=self._webhook_url, secret_token=WEBHOOK_SECRET)
+            self._http = httpx.AsyncClient(headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET})
+        await self.app.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._http:
+            await self._http.aclose()
+        if self.app.updater.running:
+            await self.app.updater.stop()
+        await self.app.stop()
+        await self.app.post_shutdown(self.app)
+        await self.app.shutdown()
+
+    async def _finished(self, update, context):
+        self._latencies.append(time.perf_counter() - self._started.pop(update.update_id))
+        if len(self._latencies) == self._expected:
+            self._done.set()
+
+    async def feed(self, stream, rate: float = None):
+        """Подаёт апдейты с частотой rate (None — сразу все) и ждёт конца обработки: (секунды, задержки)."""
+        from telegram import Update
+
+        if not stream:
+            return 0.0, []
+        self._latencies, self._expected = [], len(stream)
+        self._done.clear()
+        t0 = time.perf_counter()
+        for i, data in enumerate(stream):
+            delay = t0 + i / rate - time.perf_counter() if rate else 0
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._started[data["update_id"]] = time.perf_counter()
+            if self.transport == "polling":
+                self.fake_tg.push_updates([data])
+            elif self.transport == "webhook":
+                # Как и Telegram, следующий апдейт шлём после ответа на предыдущий
+                (await self._http.post(self._webhook_url, json=data)).raise_for_status()
+            else:
+                await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+        await asyncio.wait_for(self._done.wait(), timeout=600)
+        return time.perf_counter() - t0, self._latencies
+
+    async def settle(self, timeout: float = 120):
+        """Ждёт, пока outbox отправит всё отложенное (записи в БД и уведомления)."""
+        deadline = time.monotonic() + timeout
+        while any(st["depth"] for st in self.bot.outbox.stats().values()):
+            if time.monotonic() > deadline:
+                raise TimeoutError("outbox не опустел")
+            await asyncio.sleep(0.01)
+
+
+async def replay(bot, stream, rate: float, concurrency: int, transport: str = "queue", fake_tg=None):
+    """Подаёт апдейты в Application с заданной частотой и меряет время от поступления до конца обработки."""
+    async with Driver(bot, concurrency, transport, fake_tg) as driver:
+        return await driver.feed(stream, rate)
+
+
+def bench_loadtest(args):
+    fake_db = FakeSupabase(latency=args.db_latency)
+    fake_tg = FakeTelegram(latency=args.tg_latency)
+    # У фейка нет flood control, поэтому глобальный лимит отправки по умолчанию поднят,
+    # чтобы мерить сам бот; --send-rate 30 покажет поведение с реальным лимитом Telegram.
+    bot = load_bot(fake_db.start(), fake_tg.start(), GLOBAL_SEND_RATE=args.send_rate)
+    stream = interleave({10_000 + i: survey_script() for i in range(args.users)})
+
+    # sequential/concurrent мерят только обработку; polling и webhook — ещё и доставку апдейтов в бота.
+    modes = (("sequential", 1, "queue"), ("concurrent", args.concurrency, "queue"),
+             ("polling", args.concurrency, "polling"), ("webhook", args.concurrency, "webhook"))
+    print(f"{'mode':<12}{'updates':>9}{'seconds':>10}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for mode, concurrency, transport in modes:
+        fake_db.tables = {name: [] for name in PRIMARY_KEYS}
+        bot._known_users.clear()
+        bot.progress_cache._data.clear()
+        elapsed, latencies = asyncio.run(replay(bot, stream, args.rate, concurrency, transport, fake_tg))
+        print(f"{mode:<12}{len(stream):>9}{elapsed:>10.2f}{len(stream) / elapsed:>10.1f}"
+              f"{_percentile(latencies, 50) * 1000:>10.1f}{_percentile(latencies, 99) * 1000:>10.1f}")
+    fake_db.stop()
+    fake_tg.stop()
+
+
+# ---------- Сценарий: набор пользовательских сценариев ----------
+def _scripts(uids, steps):
+    return {uid: list(steps) for uid in uids}
+
+
+def _moderator_replies(uids, fake_db):
+    feedback_ids = [row["id"] for row in fake_db.tables["feedback"] if row["user_id"] in set(uids)]
+    steps = []
+    for fb_id in feedback_ids:
+        steps += [("callback", f"reply_fb_{fb_id}"), ("message", f"Ответ на обращение #{fb_id}")]
+    return {MODERATOR_ID: steps}
+
+
+START = [("message", "/start")]
+FEEDBACK = [("message", "🗣️ Обратная связь"), ("message", "Не открывается картинка во втором вопросе")]
+REPEAT = [("callback", "survey_1"), ("callback", "repeat_1"), *survey_steps()[1:]]
+
+# Сценарий: (подготовка, которая не замеряется; замеряемые шаги). Шаги — {user_id: [(вид, данные)]}.
+SUITE = {
+    "start": (lambda uids, db: {}, lambda uids, db: _scripts(uids, START)),
+    "menu": (lambda uids, db: _scripts(uids, START), lambda uids, db: _scripts(uids, [("message", "📜 Меню")])),
+    "survey": (lambda uids, db: _scripts(uids, START), lambda uids, db: _scripts(uids, survey_steps())),
+    "repeat": (lambda uids, db: _scripts(uids, survey_script()), lambda uids, db: _scripts(uids, REPEAT)),
+    "my_results": (lambda uids, db: _scripts(uids, survey_script()),
+                   lambda uids, db: _scripts(uids, [("message", "🏆 Мои ответы")])),
+    "feedback": (lambda uids, db: _scripts(uids, START), lambda uids, db: _scripts(uids, FEEDBACK)),
+    "moderator_reply": (lambda uids, db: _scripts(uids, START + FEEDBACK), _moderator_replies),
+}
+
+
+async def _run_suite(bot, fake_db, fake_tg, args, names):
+    results = []
+    async with Driver(bot, args.concurrency) as driver:
+        for i, name in enumerate(names):
+            setup, measured = SUITE[name]
+            # У каждого сценария свои пользователи, поэтому состояние прошлых сценариев не мешает.
+            uids = [100_000 * (i + 1) + k for k in range(args.users)]
+            prepare = setup(uids, fake_db)
+            if prepare:
+                await driver.feed(interleave(prepare))
+            await driver.settle()
+            fake_db.reset_counters()
+            fake_tg.reset_counters()
+            stream = interleave(measured(uids, fake_db))
+            elapsed, latencies = await driver.feed(stream, args.rate)
+            # Записи, отложенные в outbox, — тоже цена сценария.
+            await driver.settle()
+            results.append((name, len(stream), elapsed, latencies, dict(fake_db.requests), dict(fake_tg.calls)))
+    return results
+
+
+def bench_suite(args):
+    names = args.only.split(",") if args.only else list(SUITE)
+    unknown = [name for name in names if name not in SUITE]
+    if unknown:
+        raise SystemExit(f"Неизвестные сценарии: {', '.join(unknown)}. Есть: {', '.join(SUITE)}")
+    fake_db = FakeSupabase(latency=args.db_latency)
+    fake_tg = FakeTelegram(latency=args.tg_latency)
+    # Лимиты Telegram сняты: сценарий меряет сам бот, а не ожидание токенов отправки.
+    bot = load_bot(fake_db.start(), fake_tg.start(), GLOBAL_SEND_RATE=100_000,
+                   CHAT_SEND_RATE=100_000, CHAT_SEND_BURST=100_000)
+    results = asyncio.run(_run_suite(bot, fake_db, fake_tg, args, names))
+
+    print(f"{'scenario':<16}{'updates':>9}{'upd/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'db rt':>8}{'db/upd':>8}{'tg/upd':>8}")
+    for name, updates, elapsed, latencies, db_calls, tg_calls in results:
+        db_total, tg_total = sum(db_calls.values()), sum(tg_calls.values())
+        print(f"{name:<16}{updates:>9}{updates / elapsed:>10.1f}{_percentile(latencies, 50) * 1000:>10.1f}"
+              f"{_percentile(latencies, 95) * 1000:>10.1f}{_percentile(latencies, 99) * 1000:>10.1f}"
+              f"{db_total:>8}{db_total / updates:>8.2f}{tg_total / updates:>8.2f}")
+        if args.verbose:
+            for key, n in sorted(db_calls.items()):
+                print(f"{'':<16}db  {key}: {n}")
+            for key, n in sorted(tg_calls.items()):
+                print(f"{'':<16}tg  {key}: {n}")
+    fake_db.stop()
+    fake_tg.stop()
+
+
+# ---------- Проверки поведения ----------
+# Регрессионные проверки на тех же фейках: каждая возвращает текст ошибки или None.
+async def _check_outbox_partial_batch(bot, fake_db, fake_tg):
+    """Пачка уведомлений падает на середине: доставленные до сбоя не отправляются повторно."""
+    async with bot.build_application(with_updater=False).bot as tg_bot:
+        for i in range(3):
+            bot.notify(100 + i, f"msg {i}")
+        fake_tg.sent.clear()
+        fake_tg.fail_calls["sendMessage"] = {fake_tg.calls.get("sendMessage", 0) + 2}
+        items = bot.outbox.ready("tg", 10)
+        await bot._flush_run(tg_bot, "notify", items, set())
+        fake_tg.fail_calls.clear()
+    expected = [(100, "msg 0"), (101, "msg 1"), (102, "msg 2")]
+    if sorted(fake_tg.sent) != expected:
+        return f"отправлено {fake_tg.sent}, ожидалось {expected}"
+    left = bot.outbox.stats()["tg"]["depth"]
+    if left:
+        return f"в outbox осталось {left} записей"
+    return None
+
+
+async def _check_outbox_blocked_wakeup(bot, fake_db, fake_tg):
+    """Запись ждёт повтора: drain_outbox спит до её срока, а не крутится из-за записей за ней."""
+    uid = 4343
+    order_key = f"user:{uid}"
+    for status in ("in_progress", "completed"):
+        bot.outbox.add("progress", {"user_id": uid, "survey_number": 1, "status": status})
+    try:
+        head = bot.outbox.ready("db", 1)
+        bot.outbox.retry(head, "Supabase недоступен")
+        wait = bot.outbox.next_attempt_at("db") - time.time()
+        ready = bot.outbox.ready("db", 10)
+    finally:
+        bot.outbox._conn.execute("DELETE FROM outbox WHERE order_key = ?", (order_key,))
+    if ready:
+        return f"готово к отправке {len(ready)} записей за ждущей повтора"
+    if wait < 1:
+        return f"следующая попытка через {wait:.2f} сек, ожидался срок повтора первой записи"
+    return None
+
+
+async def _check_notify_chats_parallel(bot, fake_db, fake_tg):
+    """Пачка уведомлений одному чату упирается в его лимит и не задерживает уведомления другим чатам."""
+    async with bot.build_application(with_updater=False).bot as tg_bot:
+        for i in range(6):
+            bot.notify(bot.MODERATOR_CHAT_ID, f"Новое обращение #{i}")
+        bot.notify(500, "Ответ модератора")
+        fake_tg.sent.clear()
+        await bot._flush_run(tg_bot, "notify", bot.outbox.ready("tg", 10), set())
+    position = fake_tg.sent.index((500, "Ответ модератора"))
+    if position > bot.CHAT_SEND_BURST:
+        return f"уведомление другому чату отправлено {position + 1}-м, после уведомлений модератору"
+    return None
+
+
+async def _check_session_restart_text(bot, fake_db, fake_tg):
+    """Сессия потеряна, пользователь отвечает текстом: бот сообщает о перезапуске и присылает первый вопрос."""
+    uid = 4444
+    fake_db.tables["survey_progress"] = [
+        {"user_id": uid, "survey_number": n, "status": "in_progress" if n == 1 else "not_started"} for n in (1, 2)
+    ]
+    bot.user_states.pop(uid)
+    bot.progress_cache._data.pop(uid, None)
+    fake_tg.sent.clear()
+    fake_tg.reset_counters()
+    async with Driver(bot, 4) as driver:
+        await driver.feed([make_message(1, uid, "Ответ на третий вопрос")])
+    questions = fake_tg.calls.get("sendPhoto", 0) + fake_tg.calls.get("sendMessage", 0) - 1
+    if (uid, bot.SESSION_RESTARTED_TEXT) not in fake_tg.sent or questions < 1:
+        return f"отправлено {fake_tg.sent}, вызовов {fake_tg.calls}; ожидались уведомление и первый вопрос"
+    return None
+
+
+async def _check_paging_max_rows(bot, fake_db, fake_tg):
+    """Сервер режет ответы короче limit: выгрузка, пересчёт /stats и индекс поиска всё равно читают всё."""
+    rows = 2500
+    fake_db.tables["survey_results"] = [
+        {"id": i, "user_id": i, "survey_number": 1, "question_number": 1, "answer": "a", "created_at": "2024-01-01"}
+        for i in range(1, rows + 1)
+    ]
+    fake_db.tables["survey_progress"] = [{"user_id": i, "survey_number": 1, "status": "completed"} for i in range(1, rows + 1)]
+    fake_db.tables["feedback"] = [
+        {"id": i, "user_id": i, "message": f"m{i}", "status": "new", "created_at": "2024-01-01"} for i in range(1, rows + 1)
+    ]
+    fake_db.tables["moderator_replies"] = []
+    fake_db.max_rows = 700
+    try:
+        path = os.path.join(tempfile.mkdtemp(prefix="bot-check-"), "survey_results.csv")
+        exported = await bot.export_table("survey_results", "csv", path)
+        await bot.rebuild_stats()
+        completed = bot.survey_stats.progress().get(1, {}).get("completed", 0)
+        indexed = await bot.sync_search_index()
+    finally:
+        fake_db.max_rows = None
+    got = {"export": exported, "stats": completed, "search": indexed}
+    wrong = {name: n for name, n in got.items() if n != rows}
+    return f"прочитано {wrong} из {rows} строк" if wrong else None
+
+
+async def _check_progress_pending_outbox(bot, fake_db, fake_tg):
+    """Кэш прогресса истёк, пока завершение опроса ждёт в outbox: статус берётся из outbox, а не из БД."""
+    uid = 4242
+    await bot.add_user(uid, "u", "U")
+    await bot.set_survey_progress(uid, 1, "in_progress")
+    await bot.commit_survey(uid, 1, {"1": "a"})
+    bot.progress_cache._data.pop(uid, None)
+    try:
+        statuses = await bot.get_progress_map(uid)
+    finally:
+        bot.outbox._conn.execute("DELETE FROM outbox WHERE order_key = ?", (f"user:{uid}",))
+        bot.progress_cache._data.pop(uid, None)
+    if statuses.get(1) != "completed":
+        return f"опрос 1 в статусе {statuses.get(1)!r}, ожидался 'completed'"
+    return None
+
+
+async def _check_results_cache_generation(bot, fake_db, fake_tg):
+    """Сброс «Мои ответы» одного пользователя не мешает кэшировать чтение другого; свой сброс — мешает."""
+    cache = bot.UserCache(max_users=2, ttl=60)
+    before = cache.generation(1)
+    cache.invalidate(2)
+    if cache.generation(1) != before:
+        return "invalidate другого пользователя сменил поколение"
+    before = cache.generation(1)
+    cache.invalidate(1)
+    for uid in (3, 4):
+        # Метка пользователя 1 вытеснена, но сброс всё равно виден
+        cache.invalidate(uid)
+    if cache.generation(1) == before:
+        return "invalidate пользователя не сменил его поколение"
+    return None
+
+
+async def _check_file_ids_shared(bot, fake_db, fake_tg):
+    """Два процесса с общим file_ids.json: изменения одного не затирают изменения другого."""
+    path = os.path.join(tempfile.mkdtemp(prefix="bot-check-"), "file_ids.json")
+    first, second = bot.FileIdStore(path), bot.FileIdStore(path)
+    first.put("https://img/1.jpg", "fid-1")
+    second.put("https://img/2.jpg", "fid-2")
+    first.forget("https://img/1.jpg")
+    with open(path, encoding="utf-8") as f:
+        saved = json.load(f)
+    if set(saved) != {"https://img/2.jpg"}:
+        return f"в файле {sorted(saved)}, ожидался только https://img/2.jpg"
+    return None
+
+
+async def _check_outbox_read_stats(bot, fake_db, fake_tg):
+    """/outbox читает outbox других воркеров только на чтение и не создаёт их файлы."""
+    workdir = tempfile.mkdtemp(prefix="bot-check-")
+    path = os.path.join(workdir, "state.sqlite3.w1")
+    box = bot.Outbox(path)
+    box.add("notify", {"chat_id": 100, "text": "x"})
+    depth = bot.Outbox.read_stats(path)["tg"]["depth"]
+    if depth != 1:
+        return f"в очереди tg {depth}, ожидалась 1 запись"
+    missing = os.path.join(workdir, "state.sqlite3.w2")
+    try:
+        bot.Outbox.read_stats(missing)
+    except sqlite3.Error:
+        pass
+    if os.path.exists(missing):
+        return "read_stats создал файл несуществующего воркера"
+    return None
+
+
+class _StatusMessage:
+    """Сообщение о ходе фоновой задачи: запоминает последний текст вместо отправки в Telegram."""
+
+    chat_id = 1
+    text = ""
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        self.text = text
+
+
+async def _check_broadcast_max_rows(bot, fake_db, fake_tg):
+    """Сервер режет страницу пользователей короче BROADCAST_PAGE_SIZE: рассылка всё равно доходит до всех."""
+    users = 2500
+    fake_db.tables["users"] = [{"user_id": i, "username": None, "full_name": None} for i in range(1, users + 1)]
+    fake_db.max_rows = 700
+    # Лимит отправки поднят, чтобы проверка не ждала минуту на 30 сообщ./сек
+    page_size, bot.BROADCAST_PAGE_SIZE = bot.BROADCAST_PAGE_SIZE, 1000
+    send_rate, bot.GLOBAL_SEND_RATE = bot.GLOBAL_SEND_RATE, 100000
+    status = _StatusMessage()
+    try:
+        async with bot.build_application(with_updater=False).bot as tg_bot:
+            fake_tg.sent.clear()
+            await bot._run_broadcast(tg_bot, "hello", status)
+    finally:
+        fake_db.max_rows = None
+        bot.BROADCAST_PAGE_SIZE, bot.GLOBAL_SEND_RATE = page_size, send_rate
+    if len(fake_tg.sent) != users:
+        return f"отправлено {len(fake_tg.sent)} из {users}: {status.text}"
+    return None
+
+
+CHECKS = {
+    "outbox_partial_batch": _check_outbox_partial_batch,
+    "paging_max_rows": _check_paging_max_rows,
+    "progress_pending_outbox": _check_progress_pending_outbox,
+    "broadcast_max_rows": _check_broadcast_max_rows,
+    "results_cache_generation": _check_results_cache_generation,
+    "file_ids_shared": _check_file_ids_shared,
+    "outbox_read_stats": _check_outbox_read_stats,
+    "outbox_blocked_wakeup": _check_outbox_blocked_wakeup,
+    "notify_chats_parallel": _check_notify_chats_parallel,
+    "session_restart_text": _check_session_restart_text,
+}
+
+
+def bench_check(args):
+    names = args.only.split(",") if args.only else list(CHECKS)
+    unknown = [name for name in names if name not in CHECKS]
+    if unknown:
+        raise SystemExit(f"Неизвестные проверки: {', '.join(unknown)}. Есть: {', '.join(CHECKS)}")
+    fake_db = FakeSupabase()
+    fake_tg = FakeTelegram()
+    bot = load_bot(fake_db.start(), fake_tg.start())
+    failed = 0
+    for name in names:
+        error = asyncio.run(CHECKS[name](bot, fake_db, fake_tg))
+        print(f"{name:<32}{'FAIL: ' + error if error else 'ok'}")
+        failed += bool(error)
+    fake_db.stop()
+    fake_tg.stop()
+    if failed:
+        raise SystemExit(1)
+
+
+# ---------- Сценарий: масштабирование по процессам ----------
+# Фейки и воркеры работают в отдельных процессах (spawn), чтобы не делить один GIL.
+def _serve_fake(kind: str, latency: float, conn):
+    fake = (FakeSupabase if kind == "db" else FakeTelegram)(latency=latency)
+    conn.send(fake.start())
+    conn.recv()
+    fake.stop()
+
+
+def _bench_worker(queue, done, supabase_url: str, telegram_url: str, env: dict, concurrency: int):
+    """То же, что bot.run_worker, но с отметкой о каждом обработанном апдейте в очереди done."""
+    bot = load_bot(supabase_url, telegram_url, **env)
+
+    async def ack(update, context):
+        done.put((update.update_id, time.monotonic()))
+
+    async def serve():
+        from telegram import Update
+        from telegram.ext import TypeHandler
+
+        app = bot.build_application(concurrency, with_updater=False)
+        app.add_handler(TypeHandler(Update, ack), group=99)
+        await app.initialize()
+        await app.post_init(app)
+        await app.start()
+        done.put(("ready", None))
+        try:
+            await bot.feed_from_queue(app, queue)
+        finally:
+            await app.stop()
+            await app.post_shutdown(app)
+            await app.shutdown()
+
+    asyncio.run(serve())
+
+
+def _scale_round(ctx, urls, workers: int, stream, args, state_path: str):
+    queues = [ctx.Queue() for _ in range(workers)]
+    done = ctx.Queue()
+    env = {"WORKERS": workers, "STATE_DB_PATH": state_path, "GLOBAL_SEND_RATE": 100_000,
+           "CHAT_SEND_RATE": 100_000, "CHAT_SEND_BURST": 100_000, "MAX_CONCURRENT_UPDATES": args.concurrency}
+    processes = []
+    for index, queue in enumerate(queues):
+        process = ctx.Process(target=_bench_worker, args=(
+            queue, done, *urls, {**env, "WORKER_INDEX": index}, args.concurrency))
+        process.start()
+        processes.append(process)
+    for _ in range(workers):
+        done.get(timeout=120)
+
+    # Маршрутизация как у ingress: bot.shard_of по user_id (формула повторена, чтобы не импортировать бота).
+    sent = {}
+    t0 = time.monotonic()
+    for data in stream:
+        payload = data.get("message") or data.get("callback_query")
+        shard = payload["from"]["id"] % workers if payload["from"]["id"] != MODERATOR_ID else 0
+        sent[data["update_id"]] = time.monotonic()
+        queues[shard].put(data)
+    latencies = []
+    last = t0
+    for _ in stream:
+        update_id, finished = done.get(timeout=600)
+        latencies.append(finished - sent[update_id])
+        last = max(last, finished)
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        process.join(60)
+    return last - t0, latencies
+
+
+def bench_scale(args):
+    ctx = multiprocessing.get_context("spawn")
+    urls, pipes = [], []
+    for kind, latency in (("db", args.db_latency), ("tg", args.tg_latency)):
+        parent, child = ctx.Pipe()
+        ctx.Process(target=_serve_fake, args=(kind, latency, child), daemon=True).start()
+        urls.append(parent.recv())
+        pipes.append(parent)
+    workdir = tempfile.mkdtemp(prefix="bot-scale-")
+
+    print(f"{'workers':<10}{'updates':>9}{'seconds':>10}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'speedup':>9}")
+    base = None
+    for i, workers in enumerate(int(w) for w in args.workers.split(",")):
+        # Новые пользователи в каждом прогоне: /start и опрос проходят с нуля.
+        stream = interleave({100_000 * (i + 1) + k: survey_script() for k in range(args.users)})
+        elapsed, latencies = _scale_round(ctx, urls, workers, stream, args, os.path.join(workdir, f"state{i}.sqlite3"))
+        rate = len(stream) / elapsed
+        base = base or rate
+        print(f"{workers:<10}{len(stream):>9}{elapsed:>10.2f}{rate:>10.1f}{_percentile(latencies, 50) * 1000:>10.1f}"
+              f"{_percentile(latencies, 99) * 1000:>10.1f}{rate / base:>8.2f}x")
+    for pipe in pipes:
+        pipe.send("stop")
+    print(f"(ядер: {os.cpu_count()})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота на локальных фейках.")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+    db = sub.add_parser("db", help="пропускная способность слоя БД: блокирующие вызовы против пула")
+    db.add_argument("--users", type=int, default=200)
+    db.add_argument("--latency", type=float, default=0.02, help="задержка фейкового Supabase, сек")
+    db.set_defaults(func=bench_db)
+    lt = sub.add_parser("loadtest", help="поток апдейтов через обработчики: последовательно против параллельно")
+    lt.add_argument("--users", type=int, default=100)
+    lt.add_argument("--rate", type=float, default=300, help="апдейтов в секунду на входе")
+    lt.add_argument("--concurrency", type=int, default=64)
+    lt.add_argument("--db-latency", type=float, default=0.01)
+    lt.add_argument("--tg-latency", type=float, default=0.02)
+    lt.add_argument("--send-rate", type=float, default=1000, help="GLOBAL_SEND_RATE бота, сообщений/сек")
+    lt.set_defaults(func=bench_loadtest)
+    st = sub.add_parser("suite", help="сценарии по отдельности: /start, меню, опрос, повтор, обратная связь, ответы модератора")
+    st.add_argument("--users", type=int, default=100, help="пользователей в каждом сценарии")
+    st.add_argument("--rate", type=float, default=500, help="апдейтов в секунду на входе")
+    st.add_argument("--concurrency", type=int, default=64)
+    st.add_argument("--db-latency", type=float, default=0.005)
+    st.add_argument("--tg-latency", type=float, default=0.005)
+    st.add_argument("--only", help=f"через запятую: {','.join(SUITE)}")
+    st.add_argument("--verbose", action="store_true", help="разбивка запросов к БД и Bot API по методам")
+    st.set_defaults(func=bench_suite)
+    sc = sub.add_parser("scale", help="пропускная способность в многопроцессном режиме при разном числе воркеров")
+    sc.add_argument("--users", type=int, default=200)
+    sc.add_argument("--workers", default="1,2,4", help="через запятую, например 1,2,4")
+    sc.add_argument("--concurrency", type=int, default=64, help="апдейтов одновременно в каждом воркере")
+    sc.add_argument("--db-latency", type=float, default=0.005)
+    sc.add_argument("--tg-latency", type=float, default=0.005)
+    sc.set_defaults(func=bench_scale)
+    ck = sub.add_parser("check", help="регрессионные проверки поведения на фейках")
+    ck.add_argument("--only", help=f"через запятую: {','.join(CHECKS)}")
+    ck.set_defaults(func=bench_check)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,41 @@
 import os
+import re
+import sys
+import csv
+import glob
+import json
+import time
+import shutil
+import hashlib
+import heapq
+import sqlite3
+import uuid
+import itertools
+import argparse
+import tempfile
+import asyncio
 import logging
+import functools
+import inspect
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 from dotenv import load_dotenv
 from telegram import (
     ReplyKeyboardMarkup, ReplyKeyboardRemove,
     InlineKeyboardButton, InlineKeyboardMarkup, Update
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    MessageHandler, ContextTypes, filters
+    ApplicationBuilder, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler,
+    MessageHandler, TypeHandler, ContextTypes, filters
 )
 from supabase import create_client, Client
+from postgrest import ReturnMethod
 
 # ---------- Логи ----------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -22,151 +48,1778 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 MODERATOR_CHAT_ID = int(os.getenv("MODERATOR_CHAT_ID", "0"))
 
+# Режим работы: polling (по умолчанию) или webhook — локальный HTTP-сервер за reverse proxy.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Сколько апдейтов обрабатывается одновременно; 1 — строго последовательно, как раньше.
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+# Лимиты исходящих сообщений Telegram: ~30/сек на бота, ~1/сек в личный чат, 20/мин в группу.
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "30"))
+CHAT_SEND_RATE = float(os.getenv("CHAT_SEND_RATE", "1"))
+CHAT_SEND_BURST = float(os.getenv("CHAT_SEND_BURST", "3"))
+GROUP_SEND_RATE = float(os.getenv("GROUP_SEND_RATE", str(20 / 60)))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+# Сколько обращений помещается в одну страницу дайджеста /check_feedback.
+FEEDBACK_PAGE_SIZE = int(os.getenv("FEEDBACK_PAGE_SIZE", "10"))
+FEEDBACK_PREVIEW_CHARS = 300
+# Свой сервер Bot API (или локальный фейк в bench.py), например http://127.0.0.1:8081/bot
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
+# Многопроцессный режим (--workers N): один процесс принимает апдейты и раскладывает их по
+# N воркерам по user_id. WORKER_INDEX бот выставляет воркерам сам.
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+
 if not BOT_TOKEN or not SUPABASE_URL or not SUPABASE_KEY or MODERATOR_CHAT_ID == 0:
     logger.error("Проверьте .env: BOT_TOKEN, SUPABASE_URL, SUPABASE_KEY, MODERATOR_CHAT_ID должны быть заданы.")
     raise SystemExit("Недостаточно переменных окружения.")
 
+# ---------- Метрики ----------
+# Время обработчиков, функций БД, запросов к Supabase и вызовов Bot API собирается в гистограммы.
+# Снаружи они видны на http://METRICS_LISTEN:METRICS_PORT/metrics (формат Prometheus),
+# модератору — командой /perf. METRICS_PORT=0 отключает HTTP-сервер, сами замеры идут всегда.
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = 600
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        i = 0
+        while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по границам корзин (не больше максимума)."""
+        rank, seen = q * self.count, 0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """Гистограммы, счётчики ошибок и число выполняющихся вызовов по ключу (family, name)."""
+
+    def __init__(self):
+        self.latency = {}
+        self.errors = {}
+        self.in_flight = {}
+
+    def observe(self, family: str, name: str, seconds: float, failed: bool = False):
+        key = (family, name)
+        hist = self.latency.get(key)
+        if hist is None:
+            hist = self.latency[key] = Histogram()
+        hist.observe(seconds)
+        if failed:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    @contextmanager
+    def track(self, family: str, name: str):
+        key = (family, name)
+        self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        t0 = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.in_flight[key] -= 1
+            self.observe(family, name, time.perf_counter() - t0, failed)
+
+    def slowest(self, limit: int = 10):
+        """Самые медленные пути по p95: [(family, name, count, avg, p95, max, errors)]."""
+        rows = [
+            (family, name, h.count, h.sum / h.count, h.quantile(0.95), h.max, self.errors.get((family, name), 0))
+            for (family, name), h in self.latency.items() if h.count
+        ]
+        rows.sort(key=lambda r: r[4], reverse=True)
+        return rows[:limit]
+
+    def render(self, gauges=()) -> str:
+        """Текст в формате Prometheus; gauges — дополнительные значения (имя, тип, метки, значение)."""
+        out = [
+            "# HELP bot_latency_seconds Время выполнения обработчиков, функций БД и внешних вызовов.",
+            "# TYPE bot_latency_seconds histogram",
+        ]
+        for (family, name), h in sorted(self.latency.items()):
+            labels = f'family="{_label_value(family)}",name="{_label_value(name)}"'
+            seen = 0
+            for bound, n in zip(LATENCY_BUCKETS, h.counts):
+                seen += n
+                out.append(f'bot_latency_seconds_bucket{{{labels},le="{bound}"}} {seen}')
+            out.append(f'bot_latency_seconds_bucket{{{labels},le="+Inf"}} {h.count}')
+            out.append(f"bot_latency_seconds_sum{{{labels}}} {h.sum:.6f}")
+            out.append(f"bot_latency_seconds_count{{{labels}}} {h.count}")
+        out += ["# HELP bot_errors_total Вызовы, завершившиеся исключением.", "# TYPE bot_errors_total counter"]
+        for (family, name), n in sorted(self.errors.items()):
+            out.append(f'bot_errors_total{{family="{_label_value(family)}",name="{_label_value(name)}"}} {n}')
+        out += ["# HELP bot_in_flight Вызовы, выполняющиеся прямо сейчас.", "# TYPE bot_in_flight gauge"]
+        for (family, name), n in sorted(self.in_flight.items()):
+            out.append(f'bot_in_flight{{family="{_label_value(family)}",name="{_label_value(name)}"}} {n}')
+        last_name = None
+        for name, kind, labels, value in gauges:
+            if name != last_name:
+                out.append(f"# TYPE {name} {kind}")
+                last_name = name
+            label_text = ",".join(f'{k}="{_label_value(v)}"' for k, v in labels.items())
+            out.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(out) + "\n"
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+
+
+def timed(family: str, name: str = None):
+    """Декоратор: замеряет время вызова функции (обычной или async) в metrics."""
+    def decorate(fn):
+        label = name or fn.__name__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with metrics.track(family, label):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with metrics.track(family, label):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профилировщик: отдельный поток каждые PROFILE_INTERVAL секунд снимает стек
+    потока event loop через sys._current_frames(). Включается на время командой /perf profile,
+    в остальное время ничего не стоит.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.leaf = Counter()
+        self.cumulative = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, thread_id: int):
+        self.samples = 0
+        self.leaf.clear()
+        self.cumulative.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(thread_id,), name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self, thread_id: int):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            code = frame.f_code
+            self.leaf[f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"] += 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                label = f"{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}"
+                if label not in seen:
+                    seen.add(label)
+                    self.cumulative[label] += 1
+                frame = frame.f_back
+
+    def report(self, limit: int = 10) -> str:
+        if not self.samples:
+            return "Профиль пуст: ни одного сэмпла."
+        lines = [f"Сэмплов: {self.samples} (раз в {self.interval * 1000:.0f} мс)", "", "Где выполнялся код (self):"]
+        lines += [f"  {n / self.samples:6.1%}  {label}" for label, n in self.leaf.most_common(limit)]
+        lines += ["", "Функции бота со вложенными вызовами (cumulative):"]
+        own = [(label, n) for label, n in self.cumulative.most_common() if label.startswith("bot.py:")]
+        lines += [f"  {n / self.samples:6.1%}  {label}" for label, n in own[:limit]]
+        return "\n".join(lines)
+
+
+profiler = SamplingProfiler()
+
 # ---------- Подключение к Supabase ----------
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-# ---------- В памяти ----------
-user_states = {}
-pending_mod_replies = {}
+# Клиент supabase-py синхронный: каждый .execute() — это HTTP-запрос, который
+# блокирует поток. Поэтому запросы выполняются в ограниченном пуле потоков,
+# а обработчики только ждут результат, не останавливая event loop.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="supabase")
+
+def _query_label(query) -> str:
+    """'GET users', 'POST rpc/commit_survey' — метка запроса для метрик."""
+    request = getattr(query, "request", None)
+    path = str(getattr(request, "path", "")).rsplit("/rest/v1/", 1)[-1]
+    return f"{getattr(request, 'http_method', '?')} {path}" if path else type(query).__name__
+
+async def _execute(query):
+    loop = asyncio.get_running_loop()
+    # Время включает ожидание свободного потока в пуле — его и видит обработчик.
+    with metrics.track("supabase", _query_label(query)):
+        return await loop.run_in_executor(_db_executor, query.execute)
+
+async def _keyset_pages(table: str, columns: str, limit: int, key: str = "id", after=0):
+    """
+    Строки таблицы страницами по возрастанию key, начиная с key > after. Конец — только пустая
+    страница: сервер может обрезать ответ по «Max rows» короче limit.
+    """
+    while True:
+        r = await _execute(supabase.table(table).select(columns).gt(key, after).order(key).limit(limit))
+        rows = r.data or []
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][key]
+
+# ---------- Состояния пользователей ----------
+# Сессии опросов и ожидающие ответы модератора хранятся в SQLite (переживают перезапуск),
+# а в памяти держится только ограниченный LRU самых активных пользователей.
+STATE_DB_PATH = os.getenv(
+    "STATE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot_state.sqlite3")
+)
+
+
+def shard_state_path(index: int) -> str:
+    """
+    Файл сессий и outbox воркера. Пользователь всегда попадает в один и тот же воркер, поэтому
+    делить эти данные между процессами не нужно. Воркер 0 работает с основным файлом — там
+    остаётся outbox после однопроцессного режима.
+    """
+    return STATE_DB_PATH if index == 0 else f"{STATE_DB_PATH}.w{index}"
+
+
+SHARD_STATE_DB_PATH = shard_state_path(WORKER_INDEX)
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(24 * 3600)))
+SESSION_HOT_SIZE = int(os.getenv("SESSION_HOT_SIZE", "10000"))
+SESSION_PURGE_INTERVAL = float(os.getenv("SESSION_PURGE_INTERVAL", "600"))
+
+
+@contextmanager
+def sqlite_transaction(conn):
+    """
+    Транзакция для соединения в режиме autocommit (isolation_level=None): там `with conn:`
+    ничего не открывает и каждый запрос фиксируется сам по себе.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+class StateBackend:
+    """Долговременное хранилище состояний: значения — JSON-совместимые объекты."""
+
+    def load(self, namespace: str, key: int):
+        """Возвращает (value, updated_at) или None."""
+        raise NotImplementedError
+
+    def save(self, namespace: str, key: int, value, updated_at: float):
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: int):
+        raise NotImplementedError
+
+    def purge(self, namespace: str, older_than: float) -> int:
+        raise NotImplementedError
+
+
+class SQLiteStateBackend(StateBackend):
+    # Локальный файл в режиме WAL: запись занимает доли миллисекунды, поэтому вызовы идут прямо из event loop.
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " namespace TEXT NOT NULL, key INTEGER NOT NULL, value TEXT NOT NULL, updated_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def load(self, namespace, key):
+        row = self._conn.execute(
+            "SELECT value, updated_at FROM sessions WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def save(self, namespace, key, value, updated_at):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sessions (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, json.dumps(value, ensure_ascii=False), updated_at),
+        )
+
+    def delete(self, namespace, key):
+        self._conn.execute("DELETE FROM sessions WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def purge(self, namespace, older_than):
+        return self._conn.execute(
+            "DELETE FROM sessions WHERE namespace = ? AND updated_at < ?", (namespace, older_than)
+        ).rowcount
+
+
+class SessionStore:
+    """Состояния одного вида (namespace): горячий LRU в памяти перед StateBackend, простой дольше ttl — удаление."""
+
+    def __init__(self, namespace: str, backend: StateBackend, max_hot: int, ttl: float):
+        self.namespace = namespace
+        self.backend = backend
+        self.max_hot = max_hot
+        self.ttl = ttl
+        self._hot = OrderedDict()
+
+    def get(self, key: int):
+        now = time.time()
+        entry = self._hot.get(key)
+        if entry is None:
+            entry = self.backend.load(self.namespace, key)
+            if entry is None:
+                return None
+            self._remember(key, entry)
+        value, touched = entry
+        if now - touched > self.ttl:
+            self._drop(key)
+            return None
+        self._hot.move_to_end(key)
+        return value
+
+    def set(self, key: int, value):
+        now = time.time()
+        self.backend.save(self.namespace, key, value, now)
+        self._remember(key, (value, now))
+
+    def pop(self, key: int, default=None):
+        value = self.get(key)
+        if value is None:
+            return default
+        self._drop(key)
+        return value
+
+    def __contains__(self, key: int) -> bool:
+        return self.get(key) is not None
+
+    def purge_expired(self) -> int:
+        cutoff = time.time() - self.ttl
+        for key in [k for k, (_, touched) in self._hot.items() if touched < cutoff]:
+            del self._hot[key]
+        return self.backend.purge(self.namespace, cutoff)
+
+    def _drop(self, key):
+        self._hot.pop(key, None)
+        self.backend.delete(self.namespace, key)
+
+    def _remember(self, key, entry):
+        self._hot[key] = entry
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.max_hot:
+            self._hot.popitem(last=False)
+
+
+state_backend = SQLiteStateBackend(SHARD_STATE_DB_PATH)
+user_states = SessionStore("survey", state_backend, SESSION_HOT_SIZE, SESSION_TTL)
+pending_mod_replies = SessionStore("mod_reply", state_backend, SESSION_HOT_SIZE, SESSION_TTL)
+awaiting_feedback = SessionStore("feedback", state_backend, SESSION_HOT_SIZE, SESSION_TTL)
+# Последний запрос /search модератора — по нему листаются страницы результатов.
+search_queries = SessionStore("search", state_backend, SESSION_HOT_SIZE, SESSION_TTL)
+
+# ---------- Outbox ----------
+# Записи в Supabase и уведомления в Telegram сначала попадают в локальный журнал (SQLite),
+# обработчик сразу отвечает пользователю, а фоновый drain_outbox отправляет их пачками
+# с повторами. Так сбои и задержки Supabase/Telegram не теряют данные и не тормозят ответы.
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "20"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "300"))
+# Очереди обрабатываются независимо: недоступный Telegram не задерживает записи в БД.
+OUTBOX_LANES = {"db": ("progress", "commit_survey", "feedback", "moderator_reply"), "tg": ("notify",)}
+# Записи, меняющие survey_progress: get_progress_map накладывает их на прочитанное из БД.
+PROGRESS_OUTBOX_KINDS = ("progress", "commit_survey")
+
+
+class Outbox:
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, lane TEXT NOT NULL, kind TEXT NOT NULL,"
+            " idempotency_key TEXT NOT NULL UNIQUE, payload TEXT NOT NULL, created_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL DEFAULT 0,"
+            " dead INTEGER NOT NULL DEFAULT 0, last_error TEXT, order_key TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_lane_id ON outbox (lane, dead, id)")
+        # Порядок соблюдается только внутри order_key (пользователь, обращение, чат): запись,
+        # которая ждёт повтора, не задерживает записи других пользователей.
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_order_key ON outbox (lane, order_key, dead, id)")
+        self._lane_of = {kind: lane for lane, kinds in OUTBOX_LANES.items() for kind in kinds}
+        self._events = {}
+
+    def add(self, kind: str, payload: dict, idempotency_key: str = None) -> str:
+        key = idempotency_key or uuid.uuid4().hex
+        lane = self._lane_of[kind]
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR IGNORE INTO outbox (lane, kind, idempotency_key, payload, created_at, next_attempt_at, order_key)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (lane, kind, key, json.dumps(payload, ensure_ascii=False), now, now, self.order_key(kind, payload)),
+        )
+        self._event(lane).set()
+        return key
+
+    @staticmethod
+    def order_key(kind: str, payload: dict) -> str:
+        if kind == "moderator_reply":
+            return f"feedback:{payload['feedback_id']}"
+        if kind == "notify":
+            return f"chat:{payload['chat_id']}"
+        return f"user:{payload['user_id']}"
+
+    def ready(self, lane: str, limit: int) -> list:
+        """
+        Записи, которые можно отправлять сейчас, по порядку id: срок повтора наступил и у той же
+        order_key нет более ранней записи, ждущей повтора.
+        """
+        now = time.time()
+        rows = self._conn.execute(
+            "SELECT id, kind, idempotency_key, payload, attempts, order_key FROM outbox o"
+            " WHERE lane = ? AND dead = 0 AND next_attempt_at <= ? AND NOT EXISTS ("
+            "  SELECT 1 FROM outbox p WHERE p.lane = o.lane AND p.order_key = o.order_key AND p.dead = 0"
+            "  AND p.id < o.id AND p.next_attempt_at > ?)"
+            " ORDER BY id LIMIT ?", (lane, now, now, limit)
+        ).fetchall()
+        return [
+            {"id": r[0], "kind": r[1], "key": r[2], "payload": json.loads(r[3]), "attempts": r[4], "order_key": r[5]}
+            for r in rows
+        ]
+
+    def pending(self, order_key: str, kinds) -> list:
+        """Неотправленные записи order_key указанных видов по порядку id: [(id, kind, payload)]."""
+        kinds = list(kinds)
+        rows = self._conn.execute(
+            f"SELECT id, kind, payload FROM outbox WHERE order_key = ? AND dead = 0"
+            f" AND kind IN ({','.join('?' * len(kinds))}) ORDER BY id", (order_key, *kinds)
+        ).fetchall()
+        return [(r[0], r[1], json.loads(r[2])) for r in rows]
+
+    def next_attempt_at(self, lane: str):
+        """
+        Когда в очереди появится запись для ready(). Считаются только первые записи каждой order_key:
+        остальные ждут не своего срока, а повтора первой.
+        """
+        return self._conn.execute(
+            "SELECT MIN(next_attempt_at) FROM outbox o WHERE lane = ? AND dead = 0 AND NOT EXISTS ("
+            " SELECT 1 FROM outbox p WHERE p.lane = o.lane AND p.order_key = o.order_key AND p.dead = 0 AND p.id < o.id)",
+            (lane,)
+        ).fetchone()[0]
+
+    def done(self, items):
+        with sqlite_transaction(self._conn):
+            self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(it["id"],) for it in items])
+        # Отметка для _flush_run: запись уже отправлена, даже если пачка потом упала
+        for it in items:
+            it["done"] = True
+
+    def retry(self, items, error: str):
+        now = time.time()
+        with sqlite_transaction(self._conn):
+            for it in items:
+                attempts = it["attempts"] + 1
+                self._conn.execute(
+                    "UPDATE outbox SET attempts = ?, next_attempt_at = ?, dead = ?, last_error = ? WHERE id = ?",
+                    (attempts, now + min(2 ** attempts, OUTBOX_MAX_BACKOFF),
+                     int(attempts >= OUTBOX_MAX_ATTEMPTS), error[:500], it["id"]),
+                )
+
+    async def wait(self, lane: str, timeout: float):
+        event = self._event(lane)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    def stats(self) -> dict:
+        return self._lane_stats(self._conn)
+
+    @classmethod
+    def read_stats(cls, path: str) -> dict:
+        """stats() outbox другого процесса: соединение только для чтения, файл не меняется."""
+        conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True)
+        try:
+            return cls._lane_stats(conn)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _lane_stats(conn) -> dict:
+        now = time.time()
+        result = {}
+        for lane in OUTBOX_LANES:
+            depth, oldest = conn.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM outbox WHERE lane = ? AND dead = 0", (lane,)
+            ).fetchone()
+            dead = conn.execute("SELECT COUNT(*) FROM outbox WHERE lane = ? AND dead = 1", (lane,)).fetchone()[0]
+            result[lane] = {"depth": depth, "lag": now - oldest if oldest else 0.0, "dead": dead}
+        return result
+
+    def _event(self, lane: str) -> asyncio.Event:
+        event = self._events.get(lane)
+        if event is None:
+            event = self._events[lane] = asyncio.Event()
+        return event
+
+
+outbox = Outbox(SHARD_STATE_DB_PATH)
+# Пользователи, для которых строки users/survey_progress уже точно есть в БД.
+# При переполнении множество просто сбрасывается: лишний /start сделает upsert ещё раз.
+KNOWN_USERS_LIMIT = int(os.getenv("KNOWN_USERS_LIMIT", "100000"))
+_known_users = set()
+
+
+class UserCache:
+    """LRU-кэш значений по user_id с TTL."""
+
+    def __init__(self, max_users: int, ttl: float):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Метка последнего invalidate по пользователю: по ней видно, не устарело ли значение,
+        # пока его читали из БД. Хранятся последние max_users меток; у остальных пользователей
+        # метка — самая поздняя из вытесненных, так что сброс не теряется и после вытеснения.
+        self._stamp = 0
+        self._evicted_stamp = 0
+        self._invalidated = OrderedDict()
+        self._data = OrderedDict()
+
+    def get(self, user_id: int):
+        entry = self._data.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[user_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id: int, statuses: dict):
+        self._data[user_id] = (time.monotonic() + self.ttl, statuses)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_users:
+            self._data.popitem(last=False)
+
+    def generation(self, user_id: int) -> int:
+        return self._invalidated.get(user_id, self._evicted_stamp)
+
+    def invalidate(self, user_id: int):
+        self._stamp += 1
+        self._invalidated[user_id] = self._stamp
+        self._invalidated.move_to_end(user_id)
+        while len(self._invalidated) > self.max_users:
+            self._evicted_stamp = self._invalidated.popitem(last=False)[1]
+        self._data.pop(user_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+class ProgressCache(UserCache):
+    """Статусы опросов пользователя: {survey_number: status}."""
+
+    def update(self, user_id: int, survey_number: int, status: str):
+        # Частичные записи не кэшируем: если пользователя нет, следующий get заполнит всё одним запросом.
+        entry = self._data.get(user_id)
+        if entry is not None:
+            entry[1][survey_number] = status
+
+
+progress_cache = ProgressCache(
+    max_users=int(os.getenv("PROGRESS_CACHE_SIZE", "50000")),
+    ttl=float(os.getenv("PROGRESS_CACHE_TTL", "600")),
+)
+# Готовый текст «Мои ответы». Сбрасывается, когда ответы пользователя меняются (commit_survey).
+results_cache = UserCache(
+    max_users=int(os.getenv("RESULTS_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("RESULTS_CACHE_TTL", "3600")),
+)
 
 # ---------- Вопросы ----------
-QUESTIONS = {
-    1: [
-        {"text": "Какая природная особенность Ямало-Ненецкого автономного округа вам наиболее интересна?",
-         "options": ["Тундра и её ландшафты", "Северное сияние", "Болота и реки"],
-         "image_url": "https://kmbidgmqvjqnhmvvbjcv.supabase.co/storage/v1/object/public/survey-images/0000.jpg"},
-
-        {"text": "Какая экологическая проблема региона вызывает у вас наибольшее беспокойство?",
-         "options": ["Загрязнение от промышленности", "Изменение климата", "Загрязнение рек и озёр"],
-         "image_url": "https://kmbidgmqvjqnhmvvbjcv.supabase.co/storage/v1/object/public/survey-images/mishki.jpg"},
-
-        {"text": "Какие меры, по вашему мнению, нужно принять для сохранения природы ЯНАО?",
-         "options": None,
-         "image_url": "https://kmbidgmqvjqnhmvvbjcv.supabase.co/storage/v1/object/public/survey-images/priroda3.jpg"}
-    ],
-    2: [
-        {"text": "Что, на ваш взгляд, важнее для будущего региона?",
-         "options": ["Промышленное развитие", "Сохранение традиций", "Компромисс между ними"],
-         "image_url": "https://kmbidgmqvjqnhmvvbjcv.supabase.co/storage/v1/object/public/survey-images/region4.jpg"},
-
-        {"text": "Как вы относитесь к строительству новых дорог и мостов в ЯНАО?",
-         "options": ["Поддерживаю — нужно развивать", "Нужно осторожно — с учётом природы", "Не важно / без разницы"],
-         "image_url": "https://kmbidgmqvjqnhmvvbjcv.supabase.co/storage/v1/object/public/survey-images/dorogi5.jpg"},
-
-        {"text": "Какие проекты или инициативы вы хотели бы видеть для развития ЯНАО?",
-         "options": None,
-         "image_url": "https://kmbidgmqvjqnhmvvbjcv.supabase.co/storage/v1/object/public/survey-images/vopros6.jpg"}
-    ],
-    3: [
-        {"text": "Какие традиционные занятия жителей ЯНАО вы считаете наиболее важными для сохранения?",
-         "options": ["Оленеводство", "Рыболовство", "Народные ремёсла"],
-         "image_url": "https://kmbidgmqvjqnhmvvbjcv.supabase.co/storage/v1/object/public/survey-images/narod7.jpg"},
-
-        {"text": "Как вы оцениваете уровень сохранения культуры и языка коренных народов?",
-         "options": ["Хорошо сохраняется", "Требует срочной поддержки", "Практически утерян"],
-         "image_url": "https://kmbidgmqvjqnhmvvbjcv.supabase.co/storage/v1/object/public/survey-images/culture8.jpg"},
-
-        {"text": "Что, по вашему мнению, можно сделать для популяризации культуры ЯНАО среди молодёжи?",
-         "options": None,
-         "image_url": "https://kmbidgmqvjqnhmvvbjcv.supabase.co/storage/v1/object/public/survey-images/molodej9.jpg"}
-    ]
+# Каталог опросов лежит в questions.json. При загрузке он проверяется и компилируется
+# в неизменяемые объекты с готовыми подписями и клавиатурами, так что отправка вопроса
+# ничего не собирает заново. Файл перечитывается без перезапуска, когда меняется "version".
+QUESTIONS_PATH = os.getenv(
+    "QUESTIONS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "questions.json")
+)
+CATALOG_RELOAD_INTERVAL = float(os.getenv("CATALOG_RELOAD_INTERVAL", "30"))
+FREE_TEXT_HINT = "\n\n(Пожалуйста, ответьте сообщением.)"
+
+
+class Question:
+    __slots__ = ("survey", "number", "text", "options", "image_url", "caption", "markup")
+
+    def __init__(self, survey: int, number: int, text: str, options, image_url):
+        self.survey = survey
+        self.number = number
+        self.text = text
+        self.options = tuple(options) if options is not None else None
+        self.image_url = image_url
+        self.caption = text if self.options else text + FREE_TEXT_HINT
+        self.markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton(opt, callback_data=f"answer_{survey}_{number}_{i}")]
+            for i, opt in enumerate(self.options)
+        ]) if self.options else None
+
+    @property
+    def is_free_text(self) -> bool:
+        return self.options is None
+
+
+class Survey:
+    __slots__ = ("number", "title", "questions", "previous", "next", "completion_text", "completion_markup")
+
+    def __init__(self, number: int, title: str, questions):
+        self.number = number
+        self.title = title
+        self.questions = tuple(questions)
+        self.previous = ()
+        self.next = None
+        self.completion_text = ""
+        self.completion_markup = None
+
+    def question(self, number: int):
+        return self.questions[number - 1] if 0 < number <= len(self.questions) else None
+
+    @property
+    def last_question(self) -> int:
+        return len(self.questions)
+
+
+class Catalog:
+    __slots__ = ("version", "surveys", "order", "answers", "menu_markup")
+
+    def __init__(self, version, surveys):
+        self.version = version
+        self.order = tuple(s.number for s in surveys)
+        self.surveys = {s.number: s for s in surveys}
+        # callback_data кнопки ответа -> (вопрос, текст варианта)
+        self.answers = {}
+        for i, survey in enumerate(surveys):
+            survey.previous = self.order[:i]
+            survey.next = self.order[i + 1] if i + 1 < len(self.order) else None
+            buttons = [[InlineKeyboardButton("Вернуться в меню", callback_data="show_menu")]]
+            if survey.next is not None:
+                buttons.insert(0, [InlineKeyboardButton("Следующий опрос", callback_data=f"survey_{survey.next}")])
+                survey.completion_text = f"Спасибо за прохождение опроса №{survey.number}! 📋"
+            else:
+                survey.completion_text = "Спасибо за прохождение всех опросов! 🎉 Мы ценим ваше мнение ❤️"
+            survey.completion_markup = InlineKeyboardMarkup(buttons)
+            for q in survey.questions:
+                for j, opt in enumerate(q.options or ()):
+                    self.answers[f"answer_{survey.number}_{q.number}_{j}"] = (q, opt)
+        self.menu_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(s.title, callback_data=f"survey_{s.number}")] for s in surveys]
+            + [[InlineKeyboardButton("Обратная связь", callback_data="feedback_start")],
+               [InlineKeyboardButton("Мои ответы", callback_data="my_results")]]
+        )
+
+    def question(self, survey_number: int, question_number: int):
+        survey = self.surveys.get(survey_number)
+        return survey.question(question_number) if survey else None
+
+    def image_urls(self):
+        return [q.image_url for s in self.surveys.values() for q in s.questions if q.image_url]
+
+
+def compile_catalog(raw: dict) -> Catalog:
+    """Проверяет содержимое questions.json и собирает из него Catalog; при ошибке — ValueError."""
+    if not isinstance(raw, dict) or "version" not in raw or not isinstance(raw.get("surveys"), list) or not raw["surveys"]:
+        raise ValueError("ожидается объект с полями version и непустым списком surveys")
+    surveys, seen = [], set()
+    for s in raw["surveys"]:
+        number = s.get("number")
+        if not isinstance(number, int) or number < 1 or number in seen:
+            raise ValueError(f"некорректный или повторяющийся номер опроса: {number!r}")
+        seen.add(number)
+        questions = s.get("questions")
+        if not isinstance(questions, list) or not questions:
+            raise ValueError(f"опрос {number}: нет вопросов")
+        compiled = []
+        for q_number, q in enumerate(questions, start=1):
+            text, options = q.get("text"), q.get("options")
+            if not isinstance(text, str) or not text.strip():
+                raise ValueError(f"опрос {number}, вопрос {q_number}: пустой текст")
+            if options is not None and (
+                not isinstance(options, list) or not options
+                or not all(isinstance(o, str) and o.strip() for o in options)
+            ):
+                raise ValueError(f"опрос {number}, вопрос {q_number}: options — непустой список строк или null")
+            if options and len(f"answer_{number}_{q_number}_{len(options) - 1}".encode()) > 64:
+                raise ValueError(f"опрос {number}, вопрос {q_number}: callback_data длиннее 64 байт")
+            compiled.append(Question(number, q_number, text, options, q.get("image_url")))
+        surveys.append(Survey(number, s.get("title") or f"Опрос №{number}", compiled))
+    return Catalog(raw["version"], surveys)
+
+
+def load_catalog(path: str = QUESTIONS_PATH) -> Catalog:
+    with open(path, encoding="utf-8") as f:
+        return compile_catalog(json.load(f))
+
+
+catalog = load_catalog()
+
+# ---------- Статистика ответов ----------
+# Счётчики для /stats хранятся локально и обновляются при каждой записи ответа или статуса,
+# поэтому просмотр статистики не сканирует survey_results. Пересчёт с нуля: python bot.py --rebuild-stats
+FREE_TEXT_ANSWER = "*"
+STATS_CHUNK_SIZE = int(os.getenv("STATS_CHUNK_SIZE", "1000"))
+
+
+def stats_answer_key(survey_number: int, question_number: int, answer: str) -> str:
+    # Свободные ответы уникальны, поэтому считаем только их количество.
+    q = catalog.question(survey_number, question_number)
+    if q is not None and q.is_free_text:
+        return FREE_TEXT_ANSWER
+    return answer
+
+
+class SurveyStats:
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats_answers ("
+            " survey_number INTEGER NOT NULL, question_number INTEGER NOT NULL, answer TEXT NOT NULL,"
+            " count INTEGER NOT NULL, PRIMARY KEY (survey_number, question_number, answer))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats_progress ("
+            " survey_number INTEGER NOT NULL, status TEXT NOT NULL, count INTEGER NOT NULL,"
+            " PRIMARY KEY (survey_number, status))"
+        )
+
+    def add_answer(self, survey_number: int, question_number: int, answer: str, delta: int = 1):
+        self._conn.execute(
+            "INSERT INTO stats_answers VALUES (?, ?, ?, ?) ON CONFLICT (survey_number, question_number, answer)"
+            " DO UPDATE SET count = MAX(0, count + excluded.count)",
+            (survey_number, question_number, stats_answer_key(survey_number, question_number, answer), delta),
+        )
+
+    def move_progress(self, survey_number: int, old_status, new_status: str):
+        if old_status == new_status:
+            return
+        with sqlite_transaction(self._conn):
+            if old_status is not None:
+                self._conn.execute(
+                    "UPDATE stats_progress SET count = MAX(0, count - 1) WHERE survey_number = ? AND status = ?",
+                    (survey_number, old_status),
+                )
+            self._conn.execute(
+                "INSERT INTO stats_progress VALUES (?, ?, 1) ON CONFLICT (survey_number, status)"
+                " DO UPDATE SET count = count + 1",
+                (survey_number, new_status),
+            )
+
+    def answers(self, survey_number: int) -> dict:
+        grouped = {}
+        for q, answer, count in self._conn.execute(
+            "SELECT question_number, answer, count FROM stats_answers WHERE survey_number = ? AND count > 0"
+            " ORDER BY question_number, count DESC", (survey_number,)
+        ):
+            grouped.setdefault(q, []).append((answer, count))
+        return grouped
+
+    def progress(self) -> dict:
+        grouped = {}
+        for survey_number, status, count in self._conn.execute("SELECT survey_number, status, count FROM stats_progress"):
+            grouped.setdefault(survey_number, {})[status] = count
+        return grouped
+
+    def replace_all(self, answers: dict, progress: dict):
+        with sqlite_transaction(self._conn):
+            self._conn.execute("DELETE FROM stats_answers")
+            self._conn.execute("DELETE FROM stats_progress")
+            self._conn.executemany("INSERT INTO stats_answers VALUES (?, ?, ?, ?)",
+                                   [(s, q, a, c) for (s, q, a), c in answers.items()])
+            self._conn.executemany("INSERT INTO stats_progress VALUES (?, ?, ?)",
+                                   [(s, st, c) for (s, st), c in progress.items()])
+
+
+# Счётчики общие для всех воркеров, поэтому у них свой файл: каждое изменение берёт блокировку
+# записи, и в файле воркера 0 она задерживала бы его outbox и сессии.
+STATS_DB_PATH = os.getenv(
+    "STATS_DB_PATH", os.path.join(os.path.dirname(STATE_DB_PATH), "bot_stats.sqlite3")
+)
+survey_stats = SurveyStats(STATS_DB_PATH)
+
+# ---------- Поиск по переписке поддержки ----------
+# Обращения и ответы модератора копируются в локальный SQLite с индексом FTS5: новые — сразу
+# при записи через outbox, история и всё, что попало в Supabase в обход бота, — фоновой
+# синхронизацией по id. /search и /history читают только локальный файл.
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "5"))
+SEARCH_SYNC_INTERVAL = float(os.getenv("SEARCH_SYNC_INTERVAL", "300"))
+SEARCH_CHUNK_SIZE = int(os.getenv("SEARCH_CHUNK_SIZE", "1000"))
+# Отдельный файл: пачки синхронизации пишутся из потока и держат блокировку записи SQLite,
+# а в файле состояний в это время пишут outbox и сессии прямо из event loop.
+SEARCH_DB_PATH = os.getenv(
+    "SEARCH_DB_PATH", os.path.join(os.path.dirname(STATE_DB_PATH), "bot_search.sqlite3")
+)
+# Автор ответа, чьё обращение удалено из Supabase
+UNKNOWN_AUTHOR = 0
+
+
+def fts_query(text: str) -> str:
+    """Слова запроса -> запрос FTS5: все слова обязательны, каждое ищется как префикс («картинк» найдёт «картинки»)."""
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text.lower()))
+
+
+class SupportIndex:
+    """
+    support_messages — копия сообщений с индексом по пользователю для /history;
+    support_fts — полнотекстовый индекс над их текстом, его заполняет триггер.
+    id строки: id обращения * 2 или id ответа * 2 + 1, так что повторная вставка игнорируется.
+    Поиск на большой истории и запись пачек из синхронизации занимают заметное время, поэтому
+    методы вызываются в отдельном потоке (asyncio.to_thread). Записи идут через общее соединение
+    под _lock, search/history открывают своё соединение только для чтения.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS support_messages ("
+            " id INTEGER PRIMARY KEY, kind TEXT NOT NULL, source_id INTEGER NOT NULL, feedback_id INTEGER NOT NULL,"
+            " user_id INTEGER NOT NULL, created_at TEXT, body TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS support_messages_user ON support_messages (user_id, created_at, id)"
+        )
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS support_fts USING fts5("
+            " body, content='support_messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS support_messages_ai AFTER INSERT ON support_messages BEGIN"
+            " INSERT INTO support_fts (rowid, body) VALUES (new.id, new.body); END"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS support_sync (kind TEXT PRIMARY KEY, last_id INTEGER NOT NULL)")
+
+    def add_feedback(self, rows, checkpoint: int = None):
+        """Индексирует строки feedback; checkpoint сохраняется в той же транзакции."""
+        self._insert(
+            "INSERT OR IGNORE INTO support_messages VALUES (?, 'feedback', ?, ?, ?, ?, ?)",
+            [(r["id"] * 2, r["id"], r["id"], r["user_id"], r.get("created_at"), r.get("message") or "") for r in rows],
+            "feedback", checkpoint,
+        )
+
+    def add_replies(self, rows, authors: dict, checkpoint: int = None):
+        """
+        rows — строки moderator_replies, authors — {feedback_id: user_id} автора обращения;
+        ответ на обращение, которого нет в authors, сохраняется с UNKNOWN_AUTHOR.
+        """
+        self._insert(
+            "INSERT OR IGNORE INTO support_messages VALUES (?, 'reply', ?, ?, ?, ?, ?)",
+            [(r["id"] * 2 + 1, r["id"], r["feedback_id"], authors.get(r["feedback_id"], UNKNOWN_AUTHOR), r.get("created_at"),
+              r.get("reply_message") or "") for r in rows],
+            "reply", checkpoint,
+        )
+
+    def _insert(self, sql: str, params: list, kind: str, checkpoint):
+        with self._lock, sqlite_transaction(self._conn):
+            self._conn.executemany(sql, params)
+            if checkpoint is not None:
+                self._conn.execute("INSERT OR REPLACE INTO support_sync VALUES (?, ?)", (kind, checkpoint))
+
+    def feedback_authors(self, feedback_ids) -> dict:
+        ids = list(feedback_ids)
+        if not ids:
+            return {}
+        with self._lock:
+            return dict(self._conn.execute(
+                f"SELECT source_id, user_id FROM support_messages WHERE kind = 'feedback'"
+                f" AND source_id IN ({','.join('?' * len(ids))})", ids
+            ))
+
+    def checkpoint(self, kind: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT last_id FROM support_sync WHERE kind = ?", (kind,)).fetchone()
+        return row[0] if row else 0
+
+    def search(self, query: str, offset: int, limit: int):
+        """Страница результатов по релевантности (bm25); вторым значением — есть ли следующая."""
+        match = fts_query(query)
+        if not match:
+            return [], False
+        rows = self._read(
+            "SELECT m.kind, m.feedback_id, m.user_id, m.created_at, snippet(support_fts, 0, '«', '»', '…', 16)"
+            " FROM support_fts JOIN support_messages m ON m.id = support_fts.rowid"
+            " WHERE support_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+            (match, limit + 1, offset),
+        )
+        return rows[:limit], len(rows) > limit
+
+    def history(self, user_id: int, offset: int, limit: int):
+        """Переписка пользователя от новых к старым; вторым значением — есть ли следующая страница."""
+        rows = self._read(
+            "SELECT kind, feedback_id, user_id, created_at, body FROM support_messages WHERE user_id = ?"
+            " ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+            (user_id, limit + 1, offset),
+        )
+        return rows[:limit], len(rows) > limit
+
+    def _read(self, sql: str, params) -> list:
+        conn = sqlite3.connect(f"file:{quote(self.path)}?mode=ro", uri=True)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+
+support_index = SupportIndex(SEARCH_DB_PATH)
+
+# ---------- Выгрузка данных ----------
+# Таблицы читаются кусками по id и пишутся в файл по мере чтения, так что память
+# не зависит от размера таблицы. Запись кусков в файл идёт в отдельном потоке.
+# Не больше «Max rows» в Supabase (по умолчанию 1000): более длинный ответ сервер обрежет
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+EXPORT_FORMATS = ("csv", "parquet")
+EXPORT_TABLES = {
+    "survey_results": ("id", "user_id", "survey_number", "question_number", "question_text", "answer", "created_at"),
+    "feedback": ("id", "user_id", "message", "status", "created_at"),
+    "moderator_replies": ("id", "feedback_id", "moderator_id", "reply_message", "created_at"),
 }
+EXPORT_INT_COLUMNS = {"id", "user_id", "survey_number", "question_number", "feedback_id", "moderator_id"}
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+# Сюда переносятся выгрузки больше лимита Telegram — их забирают с сервера вручную
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "exports"))
+
+
+def _question_text(survey_number: int, question_number: int) -> str:
+    q = catalog.question(survey_number, question_number)
+    return q.text if q else ""
+
+
+async def _iter_export_chunks(table: str):
+    columns = [c for c in EXPORT_TABLES[table] if c != "question_text"]
+    async for rows in _keyset_pages(table, ",".join(columns), EXPORT_CHUNK_SIZE):
+        if table == "survey_results":
+            for row in rows:
+                row["question_text"] = _question_text(row["survey_number"], row["question_number"])
+        yield rows
+
+
+async def export_table(table: str, fmt: str, path: str) -> int:
+    """Выгружает таблицу в CSV или Parquet, возвращает число строк."""
+    columns = EXPORT_TABLES[table]
+    total = 0
+    if fmt == "csv":
+        # utf-8-sig — чтобы Excel сразу открывал кириллицу
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+            writer.writeheader()
+            async for rows in _iter_export_chunks(table):
+                await asyncio.to_thread(writer.writerows, rows)
+                total += len(rows)
+        return total
+    if fmt == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Для выгрузки в Parquet установите pyarrow.") from None
+        schema = pa.schema([(c, pa.int64() if c in EXPORT_INT_COLUMNS else pa.string()) for c in columns])
+        with pq.ParquetWriter(path, schema) as writer:
+            async for rows in _iter_export_chunks(table):
+                await asyncio.to_thread(writer.write_table, pa.Table.from_pylist(
+                    [{c: (row.get(c) if c in EXPORT_INT_COLUMNS or row.get(c) is None else str(row[c])) for c in columns}
+                     for row in rows], schema=schema))
+                total += len(rows)
+        return total
+    raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+
+# ---------- Кэш file_id картинок ----------
+# Telegram отдаёт file_id для каждой загруженной картинки; повторная отправка по file_id
+# не заставляет Telegram заново скачивать JPEG из нашего бакета.
+FILE_ID_CACHE_PATH = os.getenv(
+    "FILE_ID_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "file_ids.json")
+)
+FILE_CACHE_CHAT_ID = int(os.getenv("FILE_CACHE_CHAT_ID", str(MODERATOR_CHAT_ID)))
+PREWARM_IMAGES = os.getenv("PREWARM_IMAGES", "1") == "1"
+# Как часто сверять картинки каталога с кэшем: по тому же URL в бакете могут заменить файл. 0 — не сверять.
+FILE_ID_REFRESH_INTERVAL = float(os.getenv("FILE_ID_REFRESH_INTERVAL", "3600"))
+
+
+class FileIdStore:
+    """
+    Локальное хранилище file_id: image_url -> {"sha256": хэш содержимого, "file_id": ...} в JSON-файле.
+    Отправка ищет file_id только по URL; sha256 — содержимое, для которого file_id проверен.
+    Сверку с тем, что сейчас лежит по URL, делает refresh_images. file_id, пойманный при обычной
+    отправке, хранится без хэша: его содержимое неизвестно, и он остаётся в кэше до первой загрузки
+    с хэшем. Файл общий для воркеров, поэтому каждое изменение накладывается на его текущую версию.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._data = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning("Не удалось прочитать %s, кэш file_id начат заново: %s", self.path, e)
+            return {}
+
+    def get(self, url: str):
+        entry = self._data.get(url)
+        if entry:
+            self.hits += 1
+            return entry["file_id"]
+        self.misses += 1
+        return None
+
+    def sha256(self, url: str):
+        entry = self._data.get(url)
+        return entry and entry.get("sha256")
+
+    def put(self, url: str, file_id: str, sha256: str = None):
+        self._save(url, {"sha256": sha256, "file_id": file_id})
+
+    def forget(self, url: str) -> bool:
+        if url not in self._data:
+            return False
+        self._save(url, None)
+        return True
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+    def _save(self, url: str, entry):
+        """Записывает (entry) или удаляет (None) url поверх того, что сейчас в файле: там могут быть file_id других воркеров."""
+        data = self._load()
+        if entry is None:
+            data.pop(url, None)
+        else:
+            data[url] = entry
+        self._data = data
+        # У каждого процесса свой временный файл: воркеры могут сохранять кэш одновременно.
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            logger.exception("Не удалось сохранить кэш file_id: %s", e)
+
+
+file_ids = FileIdStore(FILE_ID_CACHE_PATH)
+
+
+async def _send_photo(bot, chat_id: int, image_url: str, **kwargs):
+    file_id = file_ids.get(image_url)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            # file_id протух или принадлежит другому боту — отправляем по URL и кэшируем заново
+            logger.warning("file_id для %s не принят (%s), отправка по URL", image_url, e)
+            file_ids.forget(image_url)
+    msg = await bot.send_photo(chat_id=chat_id, photo=image_url, **kwargs)
+    if msg.photo:
+        # Что Telegram скачал по URL, мы не видели — хэш проставит refresh_images
+        file_ids.put(image_url, msg.photo[-1].file_id)
+    return msg
+
+
+async def refresh_images(app, upload: bool):
+    """
+    Сверяет картинки каталога с кэшем file_id по хэшу содержимого. При upload новые и изменившиеся
+    картинки загружаются в служебный чат, чтобы у первого же пользователя был готовый file_id.
+    Без upload удаляется только запись, хэш которой не совпал: file_id заново поймает отправка.
+    Запись без хэша при этом остаётся — сверить её не с чем.
+    """
+    urls = catalog.image_urls()
+    async with httpx.AsyncClient(timeout=30) as http:
+        for url in urls:
+            try:
+                resp = await http.get(url)
+                resp.raise_for_status()
+                digest = hashlib.sha256(resp.content).hexdigest()
+                cached = file_ids.sha256(url)
+                if cached == digest:
+                    continue
+                if cached:
+                    logger.info("Картинка %s изменилась, прежний file_id больше не используется", url)
+                if not upload:
+                    if cached:
+                        file_ids.forget(url)
+                    continue
+                msg = await app.bot.send_photo(chat_id=FILE_CACHE_CHAT_ID, photo=resp.content, disable_notification=True)
+                file_ids.put(url, msg.photo[-1].file_id, digest)
+                try:
+                    await msg.delete()
+                except Exception:
+                    pass
+            except Exception as e:
+                logger.warning("Не удалось сверить картинку %s: %s", url, e)
+    logger.info("Кэш file_id сверен: %s картинок", file_ids.stats()["size"])
+
+
+async def refresh_images_loop(app):
+    while True:
+        await asyncio.sleep(FILE_ID_REFRESH_INTERVAL)
+        await refresh_images(app, upload=PREWARM_IMAGES)
 
 # ---------- Функции БД ----------
-def add_user(user_id: int, username: str = None, full_name: str = None):
+@timed("db")
+async def add_user(user_id: int, username: str = None, full_name: str = None):
+    # Повторный /start от уже заведённого пользователя не ходит в БД вовсе.
+    if user_id in _known_users:
+        return
     try:
-        r = supabase.table("users").select("user_id").eq("user_id", user_id).execute()
-        if not r.data:
-            supabase.table("users").insert({
-                "user_id": user_id, "username": username, "full_name": full_name
-            }).execute()
-        for n in (1, 2, 3):
-            if not supabase.table("survey_progress").select("status").eq("user_id", user_id).eq("survey_number", n).execute().data:
-                supabase.table("survey_progress").insert({
-                    "user_id": user_id, "survey_number": n, "status": "not_started"
-                }).execute()
+        await _execute(supabase.table("users").upsert({
+            "user_id": user_id, "username": username, "full_name": full_name
+        }, ignore_duplicates=True, returning=ReturnMethod.minimal))
+        r = await _execute(supabase.table("survey_progress").upsert([
+            {"user_id": user_id, "survey_number": n, "status": "not_started"} for n in catalog.order
+        ], on_conflict="user_id,survey_number", ignore_duplicates=True))
+        # С ignore-duplicates PostgREST возвращает только реально вставленные строки.
+        for row in r.data or []:
+            survey_stats.move_progress(row["survey_number"], None, "not_started")
     except Exception as e:
         logger.exception("add_user error: %s", e)
+        return
+    if len(_known_users) >= KNOWN_USERS_LIMIT:
+        _known_users.clear()
+    _known_users.add(user_id)
 
-def get_survey_progress(user_id: int, survey_number: int) -> str:
+@timed("db")
+async def get_progress_map(user_id: int) -> dict:
+    """Статусы всех опросов пользователя: из кэша или одним запросом к survey_progress."""
+    statuses = progress_cache.get(user_id)
+    if statuses is not None:
+        return statuses
+    # Статусы, которые ещё ждут в outbox, в Supabase пока нет. Берём их до запроса и после:
+    # запись, отправленная, пока запрос шёл, могла в его ответ не попасть.
+    order_key = f"user:{user_id}"
+    pending = dict((r[0], r) for r in outbox.pending(order_key, PROGRESS_OUTBOX_KINDS))
     try:
-        res = supabase.table("survey_progress").select("status").eq("user_id", user_id).eq("survey_number", survey_number).execute()
-        if res.data:
-            return res.data[0]["status"]
+        res = await _execute(supabase.table("survey_progress").select("survey_number,status").eq("user_id", user_id))
     except Exception as e:
-        logger.exception("get_survey_progress error: %s", e)
-    return "not_started"
+        logger.exception("get_progress_map error: %s", e)
+        return {}
+    pending.update((r[0], r) for r in outbox.pending(order_key, PROGRESS_OUTBOX_KINDS))
+    statuses = {row["survey_number"]: row["status"] for row in res.data or []}
+    for _, kind, payload in sorted(pending.values(), key=lambda r: r[0]):
+        statuses[payload["survey_number"]] = payload["status"] if kind == "progress" else "completed"
+    progress_cache.put(user_id, statuses)
+    return statuses
 
-def set_survey_progress(user_id: int, survey_number: int, status: str):
-    try:
-        supabase.table("survey_progress").upsert({
-            "user_id": user_id, "survey_number": survey_number, "status": status
-        }).execute()
-    except Exception as e:
-        logger.exception("set_survey_progress error: %s", e)
+async def get_survey_progress(user_id: int, survey_number: int) -> str:
+    return (await get_progress_map(user_id)).get(survey_number, "not_started")
 
-def insert_survey_result(user_id: int, survey_number: int, question_number: int, answer: str):
-    try:
-        supabase.table("survey_results").insert({
-            "user_id": user_id, "survey_number": survey_number,
-            "question_number": question_number, "answer": answer
-        }).execute()
-    except Exception as e:
-        logger.exception("insert_survey_result error: %s", e)
+@timed("db")
+async def set_survey_progress(user_id: int, survey_number: int, status: str):
+    # Кэш и счётчики обновляются сразу, запись в БД уходит через outbox.
+    old_status = (await get_progress_map(user_id)).get(survey_number)
+    outbox.add("progress", {"user_id": user_id, "survey_number": survey_number, "status": status})
+    progress_cache.update(user_id, survey_number, status)
+    survey_stats.move_progress(survey_number, old_status, status)
 
-def insert_feedback(user_id: int, message_text: str, status: str = "new"):
-    try:
-        r = supabase.table("feedback").insert({
-            "user_id": user_id, "message": message_text, "status": status
-        }).execute()
-        if r.data and "id" in r.data[0]:
-            return r.data[0]["id"]
-    except Exception as e:
-        logger.exception("insert_feedback error: %s", e)
-    return None
+@timed("db")
+async def commit_survey(user_id: int, survey_number: int, answers: dict):
+    """
+    Ставит завершение опроса в outbox. Там оно выполняется одним RPC-вызовом (одна транзакция):
+    удалить прежние ответы по опросу, вставить новые и отметить опрос завершённым.
+    Функция commit_survey описана в БД/migrations.sql.
+    """
+    old_status = (await get_progress_map(user_id)).get(survey_number)
+    outbox.add("commit_survey", {
+        "user_id": user_id,
+        "survey_number": survey_number,
+        "answers": [{"question_number": int(q), "answer": a} for q, a in sorted(answers.items(), key=lambda x: int(x[0]))],
+    })
+    progress_cache.update(user_id, survey_number, "completed")
+    survey_stats.move_progress(survey_number, old_status, "completed")
+    results_cache.invalidate(user_id)
+
+# Три функции ниже только пишут строку в локальный outbox, в Supabase они не ходят: их отправка
+# замеряется в drain_outbox как outbox/<вид записи>, поэтому в семействе db их нет.
+def insert_feedback(user_id: int, message_text: str):
+    outbox.add("feedback", {"user_id": user_id, "message": message_text})
+
+def insert_moderator_reply(feedback_id: int, moderator_id: int, reply_message: str):
+    outbox.add("moderator_reply", {"feedback_id": feedback_id, "moderator_id": moderator_id, "reply_message": reply_message})
 
-def get_new_feedback():
+def notify(chat_id: int, text: str, reply_markup: InlineKeyboardMarkup = None, idempotency_key: str = None):
+    outbox.add("notify", {
+        "chat_id": chat_id, "text": text, "reply_markup": reply_markup.to_dict() if reply_markup else None
+    }, idempotency_key)
+
+@timed("db")
+async def get_new_feedback(after_id: int = 0, limit: int = FEEDBACK_PAGE_SIZE):
+    """Страница новых обращений с id > after_id; вторым значением — есть ли следующая страница."""
     try:
-        r = supabase.table("feedback").select("*").eq("status", "new").execute()
-        return r.data or []
+        r = await _execute(
+            supabase.table("feedback").select("id,user_id,message").eq("status", "new")
+            .gt("id", after_id).order("id").limit(limit + 1)
+        )
+        rows = r.data or []
+        return rows[:limit], len(rows) > limit
     except Exception as e:
         logger.exception("get_new_feedback error: %s", e)
-        return []
+        return [], False
 
-def update_feedback_status(feedback_id: int, status: str):
+@timed("db")
+async def get_user_results(user_id: int):
+    """Ответы пользователя {survey_number: {question_number: answer}}; при дублях побеждает последний."""
     try:
-        supabase.table("feedback").update({"status": status}).eq("id", feedback_id).execute()
+        r = await _execute(
+            supabase.table("survey_results").select("survey_number,question_number,answer")
+            .eq("user_id", user_id).order("id")
+        )
     except Exception as e:
-        logger.exception("update_feedback_status error: %s", e)
+        logger.exception("get_user_results error: %s", e)
+        return None
+    grouped = {}
+    for row in r.data or []:
+        grouped.setdefault(row["survey_number"], {})[row["question_number"]] = row["answer"]
+    return grouped
 
-def insert_moderator_reply(feedback_id: int, moderator_id: int, reply_message: str):
-    try:
-        supabase.table("moderator_replies").insert({
-            "feedback_id": feedback_id, "moderator_id": moderator_id, "reply_message": reply_message
-        }).execute()
-    except Exception as e:
-        logger.exception("insert_moderator_reply error: %s", e)
+# --- Отправка записей outbox (вызываются из drain_outbox пачками одного вида) ---
+async def _flush_progress(bot, items):
+    # В одном upsert строка не может встречаться дважды — оставляем последний статус.
+    rows = {}
+    for it in items:
+        p = it["payload"]
+        rows[(p["user_id"], p["survey_number"])] = p
+    await _execute(supabase.table("survey_progress").upsert(
+        list(rows.values()), on_conflict="user_id,survey_number", returning=ReturnMethod.minimal
+    ))
 
-def get_feedback_user(feedback_id: int):
-    try:
-        r = supabase.table("feedback").select("user_id").eq("id", feedback_id).execute()
-        if r.data:
-            return r.data[0]["user_id"]
-    except Exception as e:
-        logger.exception("get_feedback_user error: %s", e)
-    return None
+async def _flush_commits(bot, items):
+    for it in items:
+        p = it["payload"]
+        r = await _execute(supabase.rpc("commit_survey", {
+            "p_user_id": p["user_id"], "p_survey_number": p["survey_number"], "p_answers": p["answers"]
+        }))
+        # RPC возвращает удалённые ответы. При повторе после потерянного ответа это будут
+        # наши же ответы, так что счётчики /stats сходятся и в этом случае.
+        for row in r.data or []:
+            survey_stats.add_answer(p["survey_number"], row["question_number"], row["answer"], -1)
+        for a in p["answers"]:
+            survey_stats.add_answer(p["survey_number"], a["question_number"], a["answer"])
+        # «Мои ответы», прочитанные, пока запись ждала в outbox, содержат прежние ответы
+        results_cache.invalidate(p["user_id"])
+        outbox.done([it])
+
+async def _upsert_by_key(table: str, items, make_row) -> dict:
+    """Вставляет строки с idempotency_key (повторы игнорируются) и возвращает {key: row}."""
+    keys = [it["key"] for it in items]
+    r = await _execute(supabase.table(table).upsert(
+        [{**make_row(it["payload"]), "idempotency_key": it["key"]} for it in items],
+        on_conflict="idempotency_key", ignore_duplicates=True
+    ))
+    saved = {row["idempotency_key"]: row for row in r.data or []}
+    missing = [k for k in keys if k not in saved]
+    if missing:
+        # Строки, вставленные прошлой попыткой, ответ на которую потерялся
+        r = await _execute(supabase.table(table).select("*").in_("idempotency_key", missing))
+        saved.update({row["idempotency_key"]: row for row in r.data or []})
+    return saved
+
+async def _flush_feedback(bot, items):
+    saved = await _upsert_by_key("feedback", items, lambda p: {"user_id": p["user_id"], "message": p["message"], "status": "new"})
+    await asyncio.to_thread(support_index.add_feedback, list(saved.values()))
+    for it in items:
+        row = saved[it["key"]]
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("Ответить", callback_data=f"reply_fb_{row['id']}")]])
+        notify(MODERATOR_CHAT_ID, f"Новое обращение #{row['id']} от {row['user_id']}:\n\n{row['message']}", kb,
+               idempotency_key=f"{it['key']}:notify")
+
+async def _flush_moderator_replies(bot, items):
+    saved = await _upsert_by_key("moderator_replies", items, lambda p: dict(p))
+    fb_ids = sorted({it["payload"]["feedback_id"] for it in items})
+    await _execute(supabase.table("feedback").update({"status": "answered"}, returning=ReturnMethod.minimal).in_("id", fb_ids))
+    r = await _execute(supabase.table("feedback").select("id,user_id").in_("id", fb_ids))
+    targets = {row["id"]: row["user_id"] for row in r.data or []}
+    await asyncio.to_thread(support_index.add_replies, list(saved.values()), targets)
+    for it in items:
+        target = targets.get(it["payload"]["feedback_id"])
+        if target:
+            notify(target, f"Ответ модератора:\n\n{it['payload']['reply_message']}", idempotency_key=f"{it['key']}:notify")
 
-def get_user_results(user_id: int):
+async def _flush_notifications(bot, items):
+    # Лимит Telegram — 1 сообщ./сек на чат, поэтому чаты отправляются параллельно, а внутри
+    # чата по порядку: пачка уведомлений модератору не задерживает ответы пользователям.
+    chats = {}
+    for it in items:
+        chats.setdefault(it["order_key"], []).append(it)
+
+    async def send_chat(chat_items):
+        for it in chat_items:
+            p = it["payload"]
+            markup = InlineKeyboardMarkup.de_json(p["reply_markup"], bot) if p.get("reply_markup") else None
+            try:
+                await bot.send_message(chat_id=p["chat_id"], text=p["text"], reply_markup=markup)
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или сообщение некорректно — повтор не поможет
+                logger.warning("notify %s dropped: %s", p["chat_id"], e)
+            outbox.done([it])
+
+    # Ошибку поднимаем после того, как отправили остальные чаты: _flush_run повторит только неотправленное
+    results = await asyncio.gather(*(send_chat(chat_items) for chat_items in chats.values()), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+OUTBOX_HANDLERS = {
+    "progress": _flush_progress,
+    "commit_survey": _flush_commits,
+    "feedback": _flush_feedback,
+    "moderator_reply": _flush_moderator_replies,
+    "notify": _flush_notifications,
+}
+
+async def _flush_run(bot, kind: str, run, blocked: set):
+    """
+    Отправляет пачку записей одного вида. Если пачка не прошла целиком, записи отправляются
+    по одной: так одна «плохая» запись не держит остальных. Записи, которые обработчик успел
+    отправить до сбоя (outbox.done), повторно не отправляются. Ключи упавших записей попадают
+    в blocked, и более поздние записи с теми же ключами в этом проходе не отправляются.
+    """
     try:
-        r = supabase.table("survey_results").select("*").eq("user_id", user_id).order("created_at", desc=True).execute()
-        return r.data or []
+        with metrics.track("outbox", kind):
+            await OUTBOX_HANDLERS[kind](bot, run)
+        outbox.done(run)
+        return
     except Exception as e:
-        logger.exception("get_user_results error: %s", e)
-        return []
+        if len(run) == 1:
+            logger.warning("outbox %s: запись %s не отправлена, повтор позже: %s", kind, run[0]["id"], e)
+            outbox.retry(run, str(e))
+            blocked.add(run[0]["order_key"])
+            return
+        logger.warning("outbox %s: пачка из %s записей не прошла (%s), отправляю по одной", kind, len(run), e)
+    failed = 0
+    for it in run:
+        if it.get("done") or it["order_key"] in blocked:
+            continue
+        try:
+            with metrics.track("outbox", kind):
+                await OUTBOX_HANDLERS[kind](bot, [it])
+            outbox.done([it])
+        except Exception as e:
+            failed += 1
+            outbox.retry([it], str(e))
+            blocked.add(it["order_key"])
+            last_error = e
+    if failed:
+        logger.warning("outbox %s: %s из %s записей не отправлено, повтор позже: %s", kind, failed, len(run), last_error)
+
+async def drain_outbox(bot, lane: str):
+    while True:
+        items = outbox.ready(lane, OUTBOX_BATCH_SIZE)
+        if not items:
+            due = outbox.next_attempt_at(lane)
+            await outbox.wait(lane, 5 if due is None else min(5, max(due - time.time(), 0.01)))
+            continue
+        # Пачки подряд идущих записей одного вида. Порядок соблюдается внутри order_key:
+        # если запись пользователя не ушла, его следующие записи ждут её повтора.
+        blocked = set()
+        for kind, run in itertools.groupby(items, key=lambda it: it["kind"]):
+            run = [it for it in run if it["order_key"] not in blocked]
+            if run:
+                await _flush_run(bot, kind, run, blocked)
+
+async def rebuild_stats():
+    """Пересчитывает счётчики /stats с нуля, читая survey_results и survey_progress кусками по ключу."""
+    answers, progress = {}, {}
+    async for rows in _keyset_pages("survey_results", "id,survey_number,question_number,answer", STATS_CHUNK_SIZE):
+        for row in rows:
+            key = (row["survey_number"], row["question_number"],
+                   stats_answer_key(row["survey_number"], row["question_number"], row["answer"]))
+            answers[key] = answers.get(key, 0) + 1
+    # Ключ из двух колонок, _keyset_pages тут не подходит; конец — так же только пустая страница
+    last_user, last_survey = 0, 0
+    while True:
+        r = await _execute(
+            supabase.table("survey_progress").select("user_id,survey_number,status")
+            .or_(f"user_id.gt.{last_user},and(user_id.eq.{last_user},survey_number.gt.{last_survey})")
+            .order("user_id").order("survey_number").limit(STATS_CHUNK_SIZE)
+        )
+        rows = r.data or []
+        if not rows:
+            break
+        for row in rows:
+            key = (row["survey_number"], row["status"])
+            progress[key] = progress.get(key, 0) + 1
+        last_user, last_survey = rows[-1]["user_id"], rows[-1]["survey_number"]
+    survey_stats.replace_all(answers, progress)
+    logger.info("Статистика пересчитана: %s счётчиков ответов, %s счётчиков статусов", len(answers), len(progress))
+
+@timed("db")
+async def sync_search_index() -> int:
+    """Дочитывает в индекс поиска обращения и ответы с id больше запомненного; возвращает число прочитанных строк."""
+    added = 0
+    last_id = await asyncio.to_thread(support_index.checkpoint, "feedback")
+    async for rows in _keyset_pages("feedback", "id,user_id,message,created_at", SEARCH_CHUNK_SIZE, after=last_id):
+        await asyncio.to_thread(support_index.add_feedback, rows, rows[-1]["id"])
+        added += len(rows)
+    last_id = await asyncio.to_thread(support_index.checkpoint, "reply")
+    async for rows in _keyset_pages("moderator_replies", "id,feedback_id,reply_message,created_at", SEARCH_CHUNK_SIZE,
+                                    after=last_id):
+        authors = await asyncio.to_thread(support_index.feedback_authors, {row["feedback_id"] for row in rows})
+        missing = sorted({row["feedback_id"] for row in rows} - authors.keys())
+        if missing:
+            # Обращение появилось после чтения feedback выше — индексируем его сейчас. Если его
+            # нет и в Supabase (удалено), ответ индексируется с неизвестным автором.
+            r = await _execute(supabase.table("feedback").select("id,user_id,message,created_at").in_("id", missing))
+            found = r.data or []
+            await asyncio.to_thread(support_index.add_feedback, found)
+            authors.update({row["id"]: row["user_id"] for row in found})
+        await asyncio.to_thread(support_index.add_replies, rows, authors, rows[-1]["id"])
+        added += len(rows)
+    return added
+
+async def search_sync_loop():
+    # Индекс общий для всех воркеров, синхронизирует его один
+    while True:
+        try:
+            added = await sync_search_index()
+            if added:
+                logger.info("Индекс поиска: дочитано %s сообщений", added)
+        except Exception as e:
+            logger.warning("Синхронизация индекса поиска не удалась: %s", e)
+        await asyncio.sleep(SEARCH_SYNC_INTERVAL)
+
+SESSION_RESTARTED_TEXT = "Прохождение опроса прервалось, начинаем его заново с первого вопроса."
+
+@timed("db")
+async def get_session(user_id: int):
+    """
+    Текущая сессия опроса. Если её нет (перезапуск, истёк TTL), а в survey_progress опрос
+    помечен in_progress — начинает прохождение заново: ответы пишутся в БД только целиком
+    при завершении, так что недописанных ответов там не бывает. Сообщить пользователю
+    о перезапуске (SESSION_RESTARTED_TEXT) и прислать первый вопрос должен вызывающий.
+    """
+    state = user_states.get(user_id)
+    if state is not None:
+        return state
+    progress = await get_progress_map(user_id)
+    in_progress = [n for n, status in progress.items() if status == "in_progress"]
+    if not in_progress:
+        return None
+    state = {"survey": max(in_progress), "question": 1, "answers": {}}
+    user_states.set(user_id, state)
+    logger.info("Сессия пользователя %s восстановлена: опрос %s с первого вопроса", user_id, state["survey"])
+    return state
+
+async def reload_catalog_loop(app):
+    """Следит за questions.json и подменяет каталог, когда в файле меняется version."""
+    global catalog
+    last_mtime = os.path.getmtime(QUESTIONS_PATH)
+    while True:
+        await asyncio.sleep(CATALOG_RELOAD_INTERVAL)
+        try:
+            mtime = os.path.getmtime(QUESTIONS_PATH)
+            if mtime == last_mtime:
+                continue
+            last_mtime = mtime
+            fresh = load_catalog()
+        except Exception as e:
+            logger.error("Каталог вопросов не перезагружен, работает прежняя версия: %s", e)
+            continue
+        if fresh.version == catalog.version:
+            continue
+        logger.info("Каталог вопросов обновлён: версия %s -> %s", catalog.version, fresh.version)
+        catalog = fresh
+        await refresh_images(app, upload=PREWARM_IMAGES)
+
+def runtime_gauges(app):
+    """Текущие размеры очередей и кэшей для /metrics: [(имя, тип, метки, значение)]."""
+    gauges = []
+    for lane, st in outbox.stats().items():
+        gauges.append(("bot_outbox_depth", "gauge", {"lane": lane}, st["depth"]))
+        gauges.append(("bot_outbox_lag_seconds", "gauge", {"lane": lane}, round(st["lag"], 3)))
+        gauges.append(("bot_outbox_dead", "gauge", {"lane": lane}, st["dead"]))
+    scheduler = app.bot.rate_limiter
+    if isinstance(scheduler, OutboundScheduler):
+        gauges.append(("bot_send_queue_depth", "gauge", {}, scheduler.queue_depth()))
+        gauges.append(("bot_send_retries_total", "counter", {}, scheduler.retries))
+    for cache, st in (("progress", progress_cache.stats()), ("results", results_cache.stats()),
+                      ("file_id", file_ids.stats())):
+        gauges.append(("bot_cache_hits_total", "counter", {"cache": cache}, st["hits"]))
+        gauges.append(("bot_cache_misses_total", "counter", {"cache": cache}, st["misses"]))
+    gauges.sort(key=lambda g: g[0])
+    return gauges
+
+async def serve_metrics(app):
+    """Минимальный HTTP-сервер: GET /metrics отдаёт метрики в текстовом формате Prometheus."""
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", metrics.render(runtime_gauges(app)).encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.debug("metrics request failed: %s", e)
+        finally:
+            writer.close()
+
+    # Каждый воркер слушает свой порт: METRICS_PORT + номер воркера.
+    port = METRICS_PORT + WORKER_INDEX
+    server = await asyncio.start_server(handle, METRICS_LISTEN, port)
+    logger.info("Метрики: http://%s:%s/metrics", METRICS_LISTEN, port)
+    async with server:
+        await server.serve_forever()
+
+async def purge_sessions_loop():
+    while True:
+        await asyncio.sleep(SESSION_PURGE_INTERVAL)
+        try:
+            removed = sum(store.purge_expired()
+                          for store in (user_states, pending_mod_replies, awaiting_feedback, search_queries))
+            if removed:
+                logger.info("Удалено простаивающих сессий: %s", removed)
+        except Exception as e:
+            logger.exception("purge_sessions error: %s", e)
+
+# ---------- Отправка в Telegram ----------
+# Все вызовы Bot API идут через OutboundScheduler: лимиты Telegram на чат и на бота,
+# приоритет ответов пользователям над рассылками, пауза по RetryAfter.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Забирает токен и возвращает 0, либо возвращает, сколько секунд ждать до следующего."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """
+    Через этот планировщик идут все вызовы Bot API с chat_id. Сначала запрос ждёт токен
+    своего чата, затем встаёт в общую очередь. Токены глобального лимита выдаются по
+    приоритету: ответы пользователям (PRIORITY_INTERACTIVE) идут раньше рассылок
+    (rate_limit_args=PRIORITY_BULK). На RetryAfter вся отправка приостанавливается
+    на указанное время, после чего запрос повторяется.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, group_rate: float,
+                 max_retries: int = 3, max_chats: int = 10000):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.sent = 0
+        self.retries = 0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()
+        self._waiting = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._dispatcher = None
+
+    async def initialize(self):
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = str(chat_id).startswith(("-", "@"))
+            bucket = TokenBucket(self.group_rate, 1) if is_group else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _dispatch(self):
+        while True:
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self._global.take()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, waiter = heapq.heappop(self._waiting)
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _acquire(self, chat_id, priority: int):
+        bucket = self._chat_bucket(chat_id)
+        while (delay := bucket.take()) > 0:
+            await asyncio.sleep(delay)
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), waiter))
+        self._wakeup.set()
+        await waiter
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # getUpdates, answerCallbackQuery, getMe и т.п. не считаются отправкой сообщений.
+            # getUpdates — это long polling, его время в метриках только мешало бы.
+            if endpoint == "getUpdates":
+                return await callback(*args, **kwargs)
+            with metrics.track("telegram", endpoint):
+                return await callback(*args, **kwargs)
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        for attempt in range(self.max_retries + 1):
+            # Ожидание в очереди лимитов и сам вызов Bot API замеряются отдельно.
+            with metrics.track("telegram_wait", endpoint):
+                await self._acquire(chat_id, priority)
+            try:
+                with metrics.track("telegram", endpoint):
+                    result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                value = e.retry_after
+                delay = (value.total_seconds() if hasattr(value, "total_seconds") else float(value)) + 0.1
+                self.retries += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logger.warning("Flood control: %s ждёт %.1f сек (попытка %s)", endpoint, delay, attempt + 1)
+                await asyncio.sleep(delay)
+
+# ---------- Параллельная обработка апдейтов ----------
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейты разных пользователей обрабатываются параллельно, апдейты одного пользователя —
+    строго в порядке поступления (asyncio.Lock выдаёт доступ ожидающим по очереди).
+
+    Семафор базового класса берётся до do_process_update, то есть и апдейтами, которые только
+    ждут своей очереди у lock пользователя. Поэтому базовый лимит сделан заведомо большим,
+    а max_concurrent_updates ограничивает свой семафор, который берётся уже под lock'ом:
+    один быстро нажимающий пользователь не занимает слоты остальных.
+    """
+
+    PENDING_LIMIT = 1_000_000
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(self.PENDING_LIMIT)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 # ---------- Клавиатуры ----------
 def get_quick_keyboard():
@@ -178,21 +1831,14 @@ def get_quick_keyboard():
 # ---------- Обработчики ----------
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    add_user(user.id, user.username or "", user.full_name or "")
+    await add_user(user.id, user.username or "", user.full_name or "")
     await update.message.reply_text(
         "Привет! 👋\nЯ бот-опросник по теме ЯНАО.\nИспользуйте кнопки ниже.",
         reply_markup=get_quick_keyboard()
     )
 
 async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("Опрос №1", callback_data="survey_1")],
-        [InlineKeyboardButton("Опрос №2", callback_data="survey_2")],
-        [InlineKeyboardButton("Опрос №3", callback_data="survey_3")],
-        [InlineKeyboardButton("Обратная связь", callback_data="feedback_start")],
-        [InlineKeyboardButton("Мои ответы", callback_data="my_results")]
-    ]
-    markup = InlineKeyboardMarkup(keyboard)
+    markup = catalog.menu_markup
     if update.callback_query:
         await update.callback_query.answer()
         await update.callback_query.edit_message_text("Главное меню:", reply_markup=markup)
@@ -208,77 +1854,40 @@ async def _reply_denied(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(msg)
 
 async def _send_question_to_user(user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    if user_id not in user_states:
+    state = user_states.get(user_id)
+    if state is None:
         return
-    state = user_states[user_id]
-    survey = state["survey"]
-    q_idx = state["question"]
-    q_obj = QUESTIONS[survey][q_idx - 1]
-    text = q_obj["text"]
-    image_url = q_obj.get("image_url")
-    options = q_obj.get("options")
+    q = catalog.question(state["survey"], state["question"])
+    if q is None:
+        # Каталог перезагружен, и такого вопроса больше нет
+        user_states.pop(user_id)
+        return await context.bot.send_message(
+            chat_id=user_id, text="Опрос изменился. Откройте меню, чтобы начать заново.", reply_markup=get_quick_keyboard()
+        )
 
     try:
-        if image_url:
-            if options is None:
-                # Без кнопок, просто фото + текст
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=image_url,
-                    caption=f"{text}\n\n(Пожалуйста, ответьте сообщением.)"
-                )
-            else:
-                # Фото + текст + кнопки
-                keyboard = [
-                    [InlineKeyboardButton(opt, callback_data=f"answer_{survey}_{q_idx}_{i}")]
-                    for i, opt in enumerate(options)
-                ]
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=image_url,
-                    caption=text,
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
+        if q.image_url:
+            await _send_photo(context.bot, chat_id=user_id, image_url=q.image_url, caption=q.caption, reply_markup=q.markup)
         else:
-            # Если картинки нет
-            if options is None:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"{text}\n\n(Пожалуйста, ответьте сообщением.)"
-                )
-            else:
-                keyboard = [
-                    [InlineKeyboardButton(opt, callback_data=f"answer_{survey}_{q_idx}_{i}")]
-                    for i, opt in enumerate(options)
-                ]
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=text,
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
+            await context.bot.send_message(chat_id=user_id, text=q.caption, reply_markup=q.markup)
     except Exception as e:
         logger.exception("Ошибка при отправке вопроса: %s", e)
 
 async def start_survey(user_id: int, survey_num: int, context: ContextTypes.DEFAULT_TYPE, reset: bool = False):
     """
-    Запускает опрос. Если reset=True — удаляет старые ответы и начинает заново.
+    Запускает опрос. Если reset=True — начинает заново: старые ответы заменятся новыми
+    при завершении опроса (commit_survey).
     """
-    # Проверка последовательности
-    if survey_num == 2 and get_survey_progress(user_id, 1) != "completed":
-        return await context.bot.send_message(chat_id=user_id, text="Вы не можете пройти этот опрос, так как не прошли предыдущие.")
-    if survey_num == 3 and (get_survey_progress(user_id, 1) != "completed" or get_survey_progress(user_id, 2) != "completed"):
+    survey = catalog.surveys.get(survey_num)
+    if survey is None:
+        return await context.bot.send_message(chat_id=user_id, text="Такого опроса нет.", reply_markup=get_quick_keyboard())
+    # Проверка последовательности: все предыдущие опросы каталога должны быть пройдены
+    progress = await get_progress_map(user_id)
+    if any(progress.get(n) != "completed" for n in survey.previous):
         return await context.bot.send_message(chat_id=user_id, text="Вы не можете пройти этот опрос, так как не прошли предыдущие.")
 
-    # Удаление старых ответов
-    if reset:
-        try:
-            supabase.table("survey_results").delete().eq("user_id", user_id).eq("survey_number", survey_num).execute()
-            logger.info(f"Старые ответы пользователя {user_id} по опросу {survey_num} удалены.")
-        except Exception as e:
-            logger.exception("Ошибка при удалении старых ответов: %s", e)
-
     # Если уже проходил и не reset
-    if not reset and get_survey_progress(user_id, survey_num) == "completed":
+    if not reset and progress.get(survey_num) == "completed":
         markup = InlineKeyboardMarkup([
             [InlineKeyboardButton("Пройти заново", callback_data=f"repeat_{survey_num}")],
             [InlineKeyboardButton("Вернуться в меню", callback_data="show_menu")]
@@ -286,8 +1895,8 @@ async def start_survey(user_id: int, survey_num: int, context: ContextTypes.DEFA
         return await context.bot.send_message(chat_id=user_id, text="Вы уже проходили этот опрос.", reply_markup=markup)
 
     # Запуск нового прохождения
-    set_survey_progress(user_id, survey_num, "in_progress")
-    user_states[user_id] = {"survey": survey_num, "question": 1}
+    await set_survey_progress(user_id, survey_num, "in_progress")
+    user_states.set(user_id, {"survey": survey_num, "question": 1, "answers": {}})
     await _send_question_to_user(user_id, context)
 
 
@@ -310,120 +1919,149 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await start_survey(user_id, int(data.split("_")[1]), context, reset=True)
 
     if data == "feedback_start":
-        context.user_data["awaiting_feedback"] = True
+        awaiting_feedback.set(user_id, True)
         return await query.message.reply_text("Напишите ваше сообщение для тех. поддержки:")
 
     if data.startswith("answer_"):
-        survey, q_idx, opt_i = map(int, data.split("_")[1:])
-        opt_text = QUESTIONS[survey][q_idx - 1]["options"][opt_i]
-        insert_survey_result(user_id, survey, q_idx, opt_text)
-        user_states[user_id]["question"] += 1
-
-        if user_states[user_id]["question"] > 3:
-            set_survey_progress(user_id, survey, "completed")
-            del user_states[user_id]
+        restored = user_id not in user_states
+        state = await get_session(user_id)
+        if state is None:
+            return await context.bot.send_message(
+                chat_id=user_id, text="Опрос не найден. Откройте меню, чтобы начать заново.",
+                reply_markup=get_quick_keyboard()
+            )
+        answer = catalog.answers.get(data)
+        if answer is None or answer[0].survey != state["survey"] or answer[0].number != state["question"]:
+            # Кнопка от уже отвеченного вопроса (или от прежней версии каталога): повторяем текущий вопрос
+            if restored:
+                await context.bot.send_message(chat_id=user_id, text=SESSION_RESTARTED_TEXT)
+            return await _send_question_to_user(user_id, context)
+        q, opt_text = answer
+        # Ответы копятся в сессии и пишутся в БД одним вызовом в конце опроса
+        state.setdefault("answers", {})[str(q.number)] = opt_text
+        survey = catalog.surveys[q.survey]
 
-            buttons = [[InlineKeyboardButton("Вернуться в меню", callback_data="show_menu")]]
-            if survey < 3:
-                buttons.insert(0, [InlineKeyboardButton("Следующий опрос", callback_data=f"survey_{survey+1}")])
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"Спасибо за прохождение опроса №{survey}! 📋",
-                    reply_markup=InlineKeyboardMarkup(buttons)
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="Спасибо за прохождение всех опросов! 🎉 Мы ценим ваше мнение ❤️",
-                    reply_markup=InlineKeyboardMarkup(buttons)
-                )
+        if q.number >= survey.last_question:
+            await commit_survey(user_id, survey.number, state["answers"])
+            user_states.pop(user_id)
+            await context.bot.send_message(
+                chat_id=user_id, text=survey.completion_text, reply_markup=survey.completion_markup
+            )
         else:
+            state["question"] += 1
+            user_states.set(user_id, state)
             await _send_question_to_user(user_id, context)
         return
 
+    if data.startswith("fb_page_"):
+        if user_id != MODERATOR_CHAT_ID:
+            return
+        text, markup = await _render_feedback_page(int(data.split("_")[-1]))
+        return await query.edit_message_text(text, reply_markup=markup)
+
+    if data.startswith("search_p_"):
+        if user_id != MODERATOR_CHAT_ID:
+            return
+        query_text = search_queries.get(user_id)
+        if query_text is None:
+            return await query.edit_message_text("Запрос устарел, повторите /search.")
+        text, markup = await _render_search_page(query_text, int(data.split("_")[-1]))
+        return await query.edit_message_text(text, reply_markup=markup)
+
+    if data.startswith("history_"):
+        if user_id != MODERATOR_CHAT_ID:
+            return
+        _, target, offset = data.split("_")
+        text, markup = await _render_history_page(int(target), int(offset))
+        return await query.edit_message_text(text, reply_markup=markup)
+
     if data.startswith("reply_fb_"):
         fb_id = int(data.split("_")[-1])
-        pending_mod_replies[user_id] = fb_id
+        pending_mod_replies.set(user_id, fb_id)
         return await context.bot.send_message(chat_id=user_id, text=f"Введите ответ для обращения #{fb_id}:")
 
 # ---------- Обработка текстов ----------
+MENU_TEXTS = ("📜 Меню", "Показать меню")
+MY_RESULTS_TEXTS = ("🏆 Мои ответы", "Мои ответы")
+FEEDBACK_TEXT = "🗣️ Обратная связь"
+QUICK_BUTTON_TEXTS = {*MENU_TEXTS, *MY_RESULTS_TEXTS, FEEDBACK_TEXT}
+
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text.strip()
 
     # Ответ модератора
-    if user_id in pending_mod_replies and user_id == MODERATOR_CHAT_ID:
+    if user_id == MODERATOR_CHAT_ID and user_id in pending_mod_replies:
         fb_id = pending_mod_replies.pop(user_id)
+        # Запись ответа, смена статуса обращения и доставка пользователю — через outbox
         insert_moderator_reply(fb_id, user_id, text)
-        update_feedback_status(fb_id, "answered")
-        target = get_feedback_user(fb_id)
-        if target:
-            await context.bot.send_message(chat_id=target, text=f"Ответ модератора:\n\n{text}")
         try:
             await update.message.edit_reply_markup(reply_markup=None)
         except:
             pass
         return await update.message.reply_text("Ответ отправлен.")
 
-    # Ответ в опросе (свободный текст)
-    if user_id in user_states:
-        survey = user_states[user_id]["survey"]
-        q_idx = user_states[user_id]["question"]
-        if QUESTIONS[survey][q_idx - 1]["options"] is None:
-            insert_survey_result(user_id, survey, q_idx, text)
-            set_survey_progress(user_id, survey, "completed")
-            del user_states[user_id]
-
-            buttons = [[InlineKeyboardButton("Вернуться в меню", callback_data="show_menu")]]
-            if survey < 3:
-                buttons.insert(0, [InlineKeyboardButton("Следующий опрос", callback_data=f"survey_{survey+1}")])
-                await update.message.reply_text(
-                    f"Спасибо за прохождение опроса №{survey}! 📋",
-                    reply_markup=InlineKeyboardMarkup(buttons)
-                )
-            else:
-                await update.message.reply_text(
-                    "Спасибо за прохождение всех опросов! 🎉 Мы ценим ваше мнение ❤️",
-                    reply_markup=InlineKeyboardMarkup(buttons)
-                )
-            return
+    # Ответ в опросе (свободный текст). Быстрые кнопки и текст обратной связи ответом
+    # восстановленной сессии не станут — для них survey_progress не читаем.
+    state = user_states.get(user_id)
+    if state is None and text not in QUICK_BUTTON_TEXTS and user_id not in awaiting_feedback:
+        state = await get_session(user_id)
+        if state is not None:
+            # Текст был ответом на вопрос прерванной сессии — к первому вопросу он не подходит
+            await update.message.reply_text(SESSION_RESTARTED_TEXT)
+            return await _send_question_to_user(user_id, context)
+    if state is not None:
+        q = catalog.question(state["survey"], state["question"])
+        if q is not None and q.is_free_text:
+            state.setdefault("answers", {})[str(q.number)] = text
+            survey = catalog.surveys[q.survey]
+            if q.number >= survey.last_question:
+                await commit_survey(user_id, survey.number, state["answers"])
+                user_states.pop(user_id)
+                return await update.message.reply_text(survey.completion_text, reply_markup=survey.completion_markup)
+            state["question"] += 1
+            user_states.set(user_id, state)
+            return await _send_question_to_user(user_id, context)
 
     # Обратная связь
-    if context.user_data.get("awaiting_feedback"):
-        fb_id = insert_feedback(user_id, text)
-        context.user_data["awaiting_feedback"] = False
-        await update.message.reply_text("Спасибо за сообщение.", reply_markup=get_quick_keyboard())
-        if fb_id:
-            kb = InlineKeyboardMarkup([[InlineKeyboardButton("Ответить", callback_data=f"reply_fb_{fb_id}")]])
-            await context.bot.send_message(chat_id=MODERATOR_CHAT_ID, text=f"Новое обращение #{fb_id} от {user_id}:\n\n{text}", reply_markup=kb)
-        return
+    if awaiting_feedback.pop(user_id):
+        # Уведомление модератору с номером обращения отправит outbox после записи в БД
+        insert_feedback(user_id, text)
+        return await update.message.reply_text("Спасибо за сообщение.", reply_markup=get_quick_keyboard())
 
     # Быстрые кнопки
-    if text in ("📜 Меню", "Показать меню"):
+    if text in MENU_TEXTS:
         return await menu_handler(update, context)
-    if text in ("🏆 Мои ответы", "Мои ответы"):
+    if text in MY_RESULTS_TEXTS:
         return await my_result_cmd(update, context)
-    if text == "🗣️ Обратная связь":
-        context.user_data["awaiting_feedback"] = True
+    if text == FEEDBACK_TEXT:
+        awaiting_feedback.set(user_id, True)
         return await update.message.reply_text("Напишите ваше сообщение:", reply_markup=ReplyKeyboardRemove())
 
 # ---------- Результаты ----------
-async def _send_my_results(user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    rows = get_user_results(user_id)
-    if not rows:
-        return await context.bot.send_message(chat_id=user_id, text="Нет сохранённых ответов.", reply_markup=get_quick_keyboard())
-    grouped = {}
-    for r in rows:
-        s = r["survey_number"]
-        qn = r["question_number"]
-        ans = r["answer"]
-        grouped.setdefault(s, {})[qn] = ans
+def render_results(grouped: dict) -> str:
+    if not grouped:
+        return "Нет сохранённых ответов."
     text_lines = []
     for s in sorted(grouped):
         text_lines.append(f"Опрос №{s}:")
         for qn in sorted(grouped[s]):
             text_lines.append(f"  Вопрос {qn}: {grouped[s][qn]}")
-    await context.bot.send_message(chat_id=user_id, text="\n".join(text_lines), reply_markup=get_quick_keyboard())
+    return "\n".join(text_lines)
+
+async def _send_my_results(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    text = results_cache.get(user_id)
+    if text is None:
+        generation = results_cache.generation(user_id)
+        grouped = await get_user_results(user_id)
+        if grouped is None:
+            return await context.bot.send_message(
+                chat_id=user_id, text="Не удалось загрузить ответы, попробуйте позже.", reply_markup=get_quick_keyboard()
+            )
+        text = render_results(grouped)
+        if results_cache.generation(user_id) == generation:
+            results_cache.put(user_id, text)
+    await context.bot.send_message(chat_id=user_id, text=text, reply_markup=get_quick_keyboard())
 
 async def my_result_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await _send_my_results(update.effective_user.id, context)
@@ -433,31 +2071,479 @@ async def my_result_cmd_callback(update: Update, context: ContextTypes.DEFAULT_T
     await _send_my_results(update.callback_query.from_user.id, context)
 
 # ---------- Модератор ----------
+async def _render_feedback_page(after_id: int = 0):
+    items, has_more = await get_new_feedback(after_id)
+    if not items:
+        return ("Новых сообщений нет." if after_id == 0 else "Больше новых сообщений нет."), None
+    lines = [f"Новые обращения (после #{after_id}):" if after_id else "Новые обращения:"]
+    buttons = []
+    for it in items:
+        msg = it.get("message") or ""
+        if len(msg) > FEEDBACK_PREVIEW_CHARS:
+            msg = msg[:FEEDBACK_PREVIEW_CHARS] + "…"
+        lines.append(f"\n#{it['id']} от {it['user_id']}:\n{msg}")
+        buttons.append(InlineKeyboardButton(f"Ответить #{it['id']}", callback_data=f"reply_fb_{it['id']}"))
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    if has_more:
+        keyboard.append([InlineKeyboardButton("Дальше ▶", callback_data=f"fb_page_{items[-1]['id']}")])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
 async def check_feedback_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != MODERATOR_CHAT_ID:
         return await update.message.reply_text("Нет прав.")
-    items = get_new_feedback()
-    if not items:
-        return await update.message.reply_text("Новых сообщений нет.")
-    for it in items:
-        fb_id = it["id"]
-        uid = it["user_id"]
-        msg = it.get("message", "")
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("Ответить", callback_data=f"reply_fb_{fb_id}")]])
-        await context.bot.send_message(chat_id=MODERATOR_CHAT_ID, text=f"#{fb_id} от {uid}:\n\n{msg}", reply_markup=kb)
-    await update.message.reply_text(f"Отправлено {len(items)} обращений.")
+    text, markup = await _render_feedback_page()
+    await update.message.reply_text(text, reply_markup=markup)
+
+SUPPORT_KIND_LABELS = {"feedback": "обращение", "reply": "ответ модератора"}
+
+def _support_line(kind, feedback_id, user_id, created_at, text) -> str:
+    when = (created_at or "")[:16].replace("T", " ")
+    if len(text) > FEEDBACK_PREVIEW_CHARS:
+        text = text[:FEEDBACK_PREVIEW_CHARS] + "…"
+    author = "неизвестен" if user_id == UNKNOWN_AUTHOR else user_id
+    return f"\n#{feedback_id}, {SUPPORT_KIND_LABELS[kind]}, пользователь {author}, {when}:\n{text}"
+
+def _page_buttons(prefix: str, offset: int, has_more: bool):
+    buttons = []
+    if offset:
+        buttons.append(InlineKeyboardButton("◀ Назад", callback_data=f"{prefix}{max(0, offset - SEARCH_PAGE_SIZE)}"))
+    if has_more:
+        buttons.append(InlineKeyboardButton("Дальше ▶", callback_data=f"{prefix}{offset + SEARCH_PAGE_SIZE}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def _render_search_page(query_text: str, offset: int = 0):
+    rows, has_more = await asyncio.to_thread(support_index.search, query_text, offset, SEARCH_PAGE_SIZE)
+    if not rows:
+        return f"По запросу «{query_text}» ничего не найдено." if offset == 0 else "Больше результатов нет.", None
+    lines = [f"Поиск «{query_text}», результаты {offset + 1}–{offset + len(rows)}:"]
+    lines += [_support_line(*row) for row in rows]
+    return "\n".join(lines), _page_buttons("search_p_", offset, has_more)
+
+async def _render_history_page(target: int, offset: int = 0):
+    rows, has_more = await asyncio.to_thread(support_index.history, target, offset, SEARCH_PAGE_SIZE)
+    if not rows:
+        return f"Переписки с пользователем {target} нет." if offset == 0 else "Более ранних сообщений нет.", None
+    lines = [f"Переписка с пользователем {target}, от новых к старым:"]
+    lines += [_support_line(*row) for row in rows]
+    return "\n".join(lines), _page_buttons(f"history_{target}_", offset, has_more)
+
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != MODERATOR_CHAT_ID:
+        return await update.message.reply_text("Нет прав.")
+    query_text = " ".join(context.args or []).strip()
+    if not fts_query(query_text):
+        return await update.message.reply_text("Использование: /search <слова из обращения или ответа>")
+    search_queries.set(update.effective_user.id, query_text)
+    text, markup = await _render_search_page(query_text)
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != MODERATOR_CHAT_ID:
+        return await update.message.reply_text("Нет прав.")
+    args = context.args or []
+    if len(args) != 1 or not args[0].lstrip("-").isdigit():
+        return await update.message.reply_text("Использование: /history <user_id>")
+    text, markup = await _render_history_page(int(args[0]))
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def _run_export(bot, tables, fmt: str, status_message):
+    for table in tables:
+        t0 = time.monotonic()
+        try:
+            # Временный каталог удаляется в любом случае — и после отправки, и после ошибки
+            with tempfile.TemporaryDirectory(prefix="export-") as tmp:
+                path = os.path.join(tmp, f"{table}.{fmt}")
+                rows = await export_table(table, fmt, path)
+                size = os.path.getsize(path)
+                if size > TELEGRAM_DOCUMENT_LIMIT:
+                    os.makedirs(EXPORT_DIR, exist_ok=True)
+                    kept = os.path.join(EXPORT_DIR, f"{table}-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}")
+                    await asyncio.to_thread(shutil.move, path, kept)
+                    await status_message.reply_text(
+                        f"{table}: {rows} строк, файл {size // (1024 * 1024)} МБ больше лимита Telegram. Сохранён на сервере: {kept}"
+                    )
+                    continue
+                with open(path, "rb") as f:
+                    await bot.send_document(
+                        chat_id=status_message.chat_id, document=f, filename=os.path.basename(path),
+                        caption=f"{table}: {rows} строк за {time.monotonic() - t0:.1f} сек"
+                    )
+        except Exception as e:
+            logger.exception("export %s error: %s", table, e)
+            await status_message.reply_text(f"Не удалось выгрузить {table}: {e}")
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != MODERATOR_CHAT_ID:
+        return await update.message.reply_text("Нет прав.")
+    args = [a.lower() for a in context.args]
+    fmt = next((a for a in args if a in EXPORT_FORMATS), "csv")
+    tables = [a for a in args if a in EXPORT_TABLES] or list(EXPORT_TABLES)
+    unknown = [a for a in args if a not in EXPORT_FORMATS and a not in EXPORT_TABLES and a != "all"]
+    if unknown:
+        return await update.message.reply_text(
+            f"Использование: /export [{'|'.join(EXPORT_TABLES)}|all] [{'|'.join(EXPORT_FORMATS)}]"
+        )
+    status_message = await update.message.reply_text(f"Выгрузка {', '.join(tables)} в {fmt} запущена...")
+    context.application.create_task(_run_export(context.bot, tables, fmt, status_message))
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != MODERATOR_CHAT_ID:
+        return await update.message.reply_text("Нет прав.")
+    if context.args and (not context.args[0].isdigit() or int(context.args[0]) not in catalog.surveys):
+        return await update.message.reply_text(f"Использование: /stats [номер опроса: {', '.join(map(str, catalog.order))}]")
+    surveys = [int(context.args[0])] if context.args else list(catalog.order)
+
+    progress = survey_stats.progress()
+    lines = ["Воронка:"]
+    prev_completed = None
+    prev_number = None
+    for n in catalog.order:
+        st = progress.get(n, {})
+        started = st.get("in_progress", 0) + st.get("completed", 0)
+        completed = st.get("completed", 0)
+        line = f"  Опрос №{n}: начали {started}, завершили {completed}"
+        if prev_completed:
+            line += f" ({completed / prev_completed:.0%} от завершивших №{prev_number})"
+        lines.append(line)
+        prev_completed, prev_number = completed, n
+
+    for n in surveys:
+        lines.append(f"\nОпрос №{n}:")
+        answers = survey_stats.answers(n)
+        for q in catalog.surveys[n].questions:
+            counts = answers.get(q.number, [])
+            lines.append(f"  Вопрос {q.number}: {q.text}")
+            if not counts:
+                lines.append("    — нет ответов")
+            for answer, count in counts:
+                label = "свободных ответов" if answer == FREE_TEXT_ANSWER else answer
+                lines.append(f"    {label}: {count}")
+    await update.message.reply_text("\n".join(lines))
+
+async def outbox_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != MODERATOR_CHAT_ID:
+        return await update.message.reply_text("Нет прав.")
+    lines = ["Outbox:"]
+    for index in range(WORKERS):
+        if WORKERS > 1:
+            lines.append(f" воркер {index}:")
+        try:
+            stats = outbox.stats() if index == WORKER_INDEX else Outbox.read_stats(shard_state_path(index))
+        except sqlite3.Error as e:
+            lines.append(f"  нет данных: {e}")
+            continue
+        for lane, st in stats.items():
+            lines.append(f"  {lane}: в очереди {st['depth']}, задержка {st['lag']:.1f} сек, не доставлено {st['dead']}")
+    await update.message.reply_text("\n".join(lines))
+
+def _worker_note() -> str:
+    """Пометка для ответов из памяти процесса: при --workers N это данные одного воркера."""
+    if WORKERS == 1:
+        return ""
+    note = f"\n\nДанные только воркера {WORKER_INDEX} из {WORKERS} (около 1/{WORKERS} пользователей)."
+    if METRICS_PORT:
+        ports = ", ".join(str(METRICS_PORT + i) for i in range(WORKERS))
+        note += f" Все воркеры — в /metrics на {METRICS_LISTEN}, порты {ports}."
+    return note
+
+async def cache_stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != MODERATOR_CHAT_ID:
+        return await update.message.reply_text("Нет прав.")
+    st = progress_cache.stats()
+    rs = results_cache.stats()
+    fs = file_ids.stats()
+    await update.message.reply_text(
+        f"Кэш прогресса: {st['size']} польз., попаданий {st['hits']}, промахов {st['misses']}, "
+        f"hit ratio {st['hit_ratio']:.1%}\n"
+        f"Кэш «Мои ответы»: {rs['size']} польз., попаданий {rs['hits']}, промахов {rs['misses']}, "
+        f"hit ratio {rs['hit_ratio']:.1%}\n"
+        f"Кэш file_id: {fs['size']} картинок, попаданий {fs['hits']}, промахов {fs['misses']}"
+        + _worker_note()
+    )
+
+async def _run_profile(seconds: float, status_message):
+    await asyncio.sleep(seconds)
+    await asyncio.to_thread(profiler.stop)
+    await status_message.reply_text(profiler.report() + _worker_note())
+
+async def perf_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/perf — самые медленные пути по p95; /perf profile [сек] — снять профиль event loop."""
+    if update.effective_user.id != MODERATOR_CHAT_ID:
+        return await update.message.reply_text("Нет прав.")
+    args = context.args or []
+    if args and args[0] == "profile":
+        if profiler.running:
+            return await update.message.reply_text("Профилирование уже идёт.")
+        try:
+            seconds = min(float(args[1]) if len(args) > 1 else 30.0, PROFILE_MAX_SECONDS)
+        except ValueError:
+            return await update.message.reply_text("Использование: /perf profile [секунды]")
+        profiler.start(threading.get_ident())
+        status_message = await update.message.reply_text(f"Профилирование на {seconds:.0f} сек...")
+        context.application.create_task(_run_profile(seconds, status_message))
+        return
+    rows = metrics.slowest()
+    if not rows:
+        return await update.message.reply_text("Замеров пока нет." + _worker_note())
+    lines = ["Самые медленные пути (p95):"]
+    for family, name, count, avg, p95, worst, errors in rows:
+        line = f"  {family}/{name}: p95 {p95 * 1000:.0f} мс, сред. {avg * 1000:.0f} мс, макс {worst * 1000:.0f} мс, вызовов {count}"
+        lines.append(line + (f", ошибок {errors}" if errors else ""))
+    busy = [f"{family}/{name}: {n}" for (family, name), n in sorted(metrics.in_flight.items()) if n]
+    if busy:
+        lines += ["", "Выполняются сейчас: " + ", ".join(busy)]
+    await update.message.reply_text("\n".join(lines) + _worker_note())
+
+async def _run_broadcast(bot, text: str, status_message):
+    sent = failed = blocked = 0
+    last_user_id = 0
+    t0 = time.monotonic()
+
+    async def deliver(uid):
+        nonlocal sent, failed, blocked
+        try:
+            await bot.send_message(chat_id=uid, text=text, rate_limit_args=PRIORITY_BULK)
+            sent += 1
+        except Forbidden:
+            blocked += 1
+        except Exception as e:
+            failed += 1
+            logger.warning("broadcast to %s failed: %s", uid, e)
+
+    # Ошибку чтения страницы не глотаем: пустая страница означала бы «пользователи закончились».
+    try:
+        async for rows in _keyset_pages("users", "user_id", BROADCAST_PAGE_SIZE, key="user_id"):
+            await asyncio.gather(*(deliver(row["user_id"]) for row in rows))
+            last_user_id = rows[-1]["user_id"]
+            elapsed = time.monotonic() - t0
+            try:
+                await status_message.edit_text(
+                    f"Рассылка идёт: отправлено {sent}, заблокировали бота {blocked}, ошибок {failed}, "
+                    f"{sent / elapsed:.1f} сообщ./сек"
+                )
+            except Exception:
+                pass
+    except Exception as e:
+        logger.exception("broadcast: не удалось получить пользователей после %s: %s", last_user_id, e)
+        elapsed = time.monotonic() - t0
+        await status_message.reply_text(
+            f"Рассылка прервана через {elapsed:.0f} сек: не удалось получить список пользователей ({e}). "
+            f"Отправлено {sent}, заблокировали бота {blocked}, ошибок {failed}; "
+            f"последний обработанный user_id: {last_user_id}."
+        )
+        return
+    elapsed = time.monotonic() - t0
+    await status_message.reply_text(
+        f"Рассылка завершена за {elapsed:.0f} сек: отправлено {sent}, заблокировали бота {blocked}, "
+        f"ошибок {failed}, {sent / max(elapsed, 1e-9):.1f} сообщ./сек"
+    )
+
+async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != MODERATOR_CHAT_ID:
+        return await update.message.reply_text("Нет прав.")
+    text = update.message.text.partition(" ")[2].strip()
+    if not text:
+        return await update.message.reply_text("Использование: /broadcast <текст сообщения>")
+    status_message = await update.message.reply_text("Рассылка запущена...")
+    # Рассылка идёт в фоне через низкоприоритетную очередь, бот продолжает отвечать пользователям.
+    context.application.create_task(_run_broadcast(context.bot, text, status_message))
 
 # ---------- Main ----------
+_background_tasks = []
+
+async def post_init(app):
+    _background_tasks.append(asyncio.create_task(purge_sessions_loop()))
+    for lane in OUTBOX_LANES:
+        _background_tasks.append(asyncio.create_task(drain_outbox(app.bot, lane)))
+    _background_tasks.append(asyncio.create_task(reload_catalog_loop(app)))
+    if METRICS_PORT:
+        _background_tasks.append(asyncio.create_task(serve_metrics(app)))
+    if WORKER_INDEX == 0:
+        _background_tasks.append(asyncio.create_task(search_sync_loop()))
+    if FILE_ID_REFRESH_INTERVAL:
+        _background_tasks.append(asyncio.create_task(refresh_images_loop(app)))
+    if PREWARM_IMAGES:
+        await refresh_images(app, upload=True)
+
+async def post_shutdown(app):
+    for task in _background_tasks:
+        task.cancel()
+    _background_tasks.clear()
+
+def build_application(max_concurrent_updates: int = MAX_CONCURRENT_UPDATES, with_updater: bool = True):
+    builder = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    if not with_updater:
+        # Воркер получает апдейты от ingress-процесса, а не из Telegram
+        builder = builder.updater(None)
+    # Лимит Telegram общий на бота, поэтому воркеры делят его поровну.
+    builder = builder.rate_limiter(
+        OutboundScheduler(GLOBAL_SEND_RATE / WORKERS, CHAT_SEND_RATE, CHAT_SEND_BURST, GROUP_SEND_RATE)
+    )
+    if max_concurrent_updates > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(max_concurrent_updates))
+    app = builder.build()
+    # Каждый обработчик обёрнут в timed: время, ошибки и число выполняющихся видны в /metrics и /perf.
+    handler = timed("handler")
+    app.add_handler(CommandHandler("start", handler(start_cmd)))
+    app.add_handler(CommandHandler("menu", handler(menu_handler)))
+    app.add_handler(CommandHandler("my_result", handler(my_result_cmd)))
+    app.add_handler(CommandHandler("check_feedback", handler(check_feedback_cmd)))
+    app.add_handler(CommandHandler("search", handler(search_cmd)))
+    app.add_handler(CommandHandler("history", handler(history_cmd)))
+    app.add_handler(CommandHandler("stats", handler(stats_cmd)))
+    app.add_handler(CommandHandler("export", handler(export_cmd)))
+    app.add_handler(CommandHandler("cache_stats", handler(cache_stats_cmd)))
+    app.add_handler(CommandHandler("outbox", handler(outbox_cmd)))
+    app.add_handler(CommandHandler("perf", handler(perf_cmd)))
+    app.add_handler(CommandHandler("broadcast", handler(broadcast_cmd)))
+    app.add_handler(CallbackQueryHandler(handler(callback_router)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handler(text_handler)))
+    return app
+
+# ---------- Многопроцессный режим ----------
+# Ingress-процесс только принимает апдейты (polling или webhook) и кладёт их в очередь воркера
+# shard_of(user_id). Апдейты одного пользователя всегда идут через одну очередь в один воркер,
+# а там PerUserUpdateProcessor сохраняет их порядок.
+def shard_of(user_id, workers: int = WORKERS) -> int:
+    """Номер воркера для пользователя; модератор и апдейты без пользователя — всегда воркер 0."""
+    if user_id is None or user_id == MODERATOR_CHAT_ID:
+        return 0
+    return user_id % workers
+
+async def feed_from_queue(app, queue):
+    """Перекладывает апдейты из очереди ingress в update_queue приложения, пока не придёт None."""
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(None, queue.get)
+        if data is None:
+            return
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+async def _serve_worker(queue, concurrency: int):
+    app = build_application(concurrency, with_updater=False)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    try:
+        await feed_from_queue(app, queue)
+    finally:
+        await app.stop()
+        await app.post_shutdown(app)
+        await app.shutdown()
+
+def run_worker(queue, concurrency: int):
+    logger.info("Воркер %s из %s запущен (pid %s)", WORKER_INDEX, WORKERS, os.getpid())
+    try:
+        asyncio.run(_serve_worker(queue, concurrency))
+    except KeyboardInterrupt:
+        # Ctrl+C получает вся группа процессов; воркер завершится по None от ingress
+        pass
+
+def _warn_orphaned_shards(workers: int):
+    for path in sorted(glob.glob(f"{glob.escape(STATE_DB_PATH)}.w*")):
+        index = path.rsplit(".w", 1)[-1]
+        if not index.isdigit() or int(index) < workers:
+            continue
+        try:
+            pending = sum(st["depth"] for st in Outbox.read_stats(path).values())
+        except sqlite3.Error:
+            continue
+        if pending:
+            logger.warning("В %s осталось %s неотправленных записей outbox: запустите бота с --workers %s, "
+                           "чтобы их отправить", path, pending, int(index) + 1)
+
+def run_sharded(workers: int, concurrency: int, webhook: bool):
+    _warn_orphaned_shards(workers)
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(workers)]
+    processes = []
+
+    async def start_workers(app):
+        if PREWARM_IMAGES:
+            # Картинки прогреваются один раз здесь; воркеры прочитают готовый кэш file_id
+            await refresh_images(app, upload=True)
+        os.environ.update({"WORKERS": str(workers), "PREWARM_IMAGES": "0"})
+        for index, queue in enumerate(queues):
+            os.environ["WORKER_INDEX"] = str(index)
+            process = ctx.Process(target=run_worker, args=(queue, concurrency), name=f"worker-{index}")
+            process.start()
+            processes.append(process)
+
+    async def stop_workers(app):
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            await asyncio.to_thread(process.join, 60)
+            if process.is_alive():
+                logger.warning("%s не завершился за минуту, останавливаю принудительно", process.name)
+                process.terminate()
+
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        queues[shard_of(user.id if user else None, workers)].put(update.to_dict())
+
+    builder = ApplicationBuilder().token(BOT_TOKEN).post_init(start_workers).post_shutdown(stop_workers)
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    app = builder.build()
+    app.add_handler(TypeHandler(Update, route))
+    logger.info("Запуск ingress: %s воркеров, %s", workers, "webhook" if webhook else "polling")
+    if webhook:
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
+
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("menu", menu_handler))
-    app.add_handler(CommandHandler("my_result", my_result_cmd))
-    app.add_handler(CommandHandler("check_feedback", check_feedback_cmd))
-    app.add_handler(CallbackQueryHandler(callback_router))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
-    logger.info("Запуск бота...")
-    app.run_polling()
+    parser = argparse.ArgumentParser(description="Бот-опросник по теме ЯНАО.")
+    parser.add_argument("--webhook", action="store_true", default=BOT_MODE == "webhook",
+                        help="принимать апдейты через webhook вместо polling (env BOT_MODE=webhook)")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_UPDATES,
+                        help="сколько апдейтов обрабатывать одновременно (1 — последовательно)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="число процессов-воркеров; больше 1 — апдейты делятся между ними по user_id")
+    parser.add_argument("--rebuild-stats", action="store_true",
+                        help="пересчитать счётчики /stats по таблицам и выйти")
+    parser.add_argument("--export", metavar="TABLE", choices=[*EXPORT_TABLES, "all"],
+                        help="выгрузить таблицу (или all) в файл и выйти")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv", help="формат выгрузки")
+    parser.add_argument("--output", default=".", help="каталог для файлов выгрузки")
+    args = parser.parse_args()
+
+    if args.rebuild_stats:
+        asyncio.run(rebuild_stats())
+        return
+    if args.export:
+        for table in EXPORT_TABLES if args.export == "all" else [args.export]:
+            path = os.path.join(args.output, f"{table}.{args.format}")
+            logger.info("%s: %s строк -> %s", table, asyncio.run(export_table(table, args.format, path)), path)
+        return
+
+    if args.webhook and not WEBHOOK_URL:
+        raise SystemExit("Для webhook-режима задайте WEBHOOK_URL.")
+    if args.workers > 1:
+        run_sharded(args.workers, args.concurrency, args.webhook)
+        return
+    app = build_application(args.concurrency)
+    if args.webhook:
+        logger.info("Запуск бота (webhook на %s:%s/%s)...", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        logger.info("Запуск бота...")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
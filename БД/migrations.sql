@@ -0,0 +1,33 @@
+-- Изменения схемы поверх дампов *_rows.sql. Выполнять в SQL Editor Supabase по порядку.
+
+-- /check_feedback: keyset-пагинация новых обращений по id.
+CREATE INDEX IF NOT EXISTS feedback_new_id_idx ON public.feedback (id) WHERE status = 'new';
+
+-- Завершение опроса одной транзакцией: удалить прежние ответы, записать новые, отметить completed.
+-- Возвращает удалённые ответы (по ним бот корректирует счётчики /stats).
+CREATE OR REPLACE FUNCTION public.commit_survey(p_user_id bigint, p_survey_number integer, p_answers jsonb)
+RETURNS TABLE (question_number integer, answer text)
+LANGUAGE plpgsql
+AS $$
+#variable_conflict use_column
+BEGIN
+    RETURN QUERY
+        DELETE FROM public.survey_results AS r
+        WHERE r.user_id = p_user_id AND r.survey_number = p_survey_number
+        RETURNING r.question_number::integer, r.answer::text;
+
+    INSERT INTO public.survey_results (user_id, survey_number, question_number, answer)
+    SELECT p_user_id, p_survey_number, (a ->> 'question_number')::integer, a ->> 'answer'
+    FROM jsonb_array_elements(p_answers) AS a;
+
+    INSERT INTO public.survey_progress (user_id, survey_number, status)
+    VALUES (p_user_id, p_survey_number, 'completed')
+    ON CONFLICT (user_id, survey_number) DO UPDATE SET status = EXCLUDED.status;
+END;
+$$;
+
+-- Outbox бота: ключи идемпотентности, чтобы повторная отправка записи не создавала дубликатов.
+ALTER TABLE public.feedback ADD COLUMN IF NOT EXISTS idempotency_key text;
+CREATE UNIQUE INDEX IF NOT EXISTS feedback_idempotency_key_idx ON public.feedback (idempotency_key);
+ALTER TABLE public.moderator_replies ADD COLUMN IF NOT EXISTS idempotency_key text;
+CREATE UNIQUE INDEX IF NOT EXISTS moderator_replies_idempotency_key_idx ON public.moderator_replies (idempotency_key);